@@ -0,0 +1,72 @@
+import json
+
+import geopandas as gpd
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# Requests to ArcGIS REST services share a session so that connections are reused. Failed requests (connection errors,
+# rate limiting, and server errors) are retried with exponential backoff
+
+_session = requests.Session()
+_adapter = HTTPAdapter(pool_connections=4, pool_maxsize=16,
+                       max_retries=Retry(total=3, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504]))
+_session.mount('https://', _adapter)
+_session.mount('http://', _adapter)
+# Maximum number of pages of a query (see read_features)
+max_pages = 100
+
+
+def _get_json(url, params=None, timeout=30):
+    r = _session.get(url, params=params, timeout=timeout)
+    r.raise_for_status()
+    result = r.json()
+    # Errors are returned with a 200 status
+    if 'error' in result:
+        raise requests.HTTPError(f"{url} returned error: {result['error']}")
+    return result
+
+
+def is_feature_query(url):
+    return '/FeatureServer/' in url and '/query' in url
+
+
+def last_edit(url):
+    # Date of the last edit of the FeatureServer layer of a query URL
+    info = _get_json(url.split('/query')[0], params={'f': 'json'}, timeout=10).get('editingInfo', {})
+    return info.get('dataLastEditDate', info.get('lastEditDate'))
+
+
+def _feature_id(feature):
+    # Object ID of a GeoJSON feature. Features without one are identified by their content
+    return feature['id'] if feature.get('id') is not None else json.dumps(feature, sort_keys=True)
+
+
+def read_features(url):
+    # All features of a FeatureServer query URL (f=geojson). A query returns at most the maxRecordCount of the layer
+    # and sets exceededTransferLimit if there are more so the remaining features are requested in pages. Layers that
+    # do not support pagination (or that ignore resultOffset and return the same page again) raise an error instead of
+    # requesting pages forever
+    features = []
+    ids = set()
+    for _ in range(max_pages):
+        page = _get_json(url, params={'resultOffset': len(features)} if features else None)
+        new = [x for x in page['features'] if _feature_id(x) not in ids]
+        features.extend(new)
+        ids.update(_feature_id(x) for x in new)
+        if not (page.get('exceededTransferLimit') or page.get('properties', {}).get('exceededTransferLimit')):
+            break
+        if len(new)==0:
+            raise requests.HTTPError(f"{url} returned a page without new features at offset {len(features)}")
+        if len(features)==len(new) and not _supports_pagination(url):
+            raise requests.HTTPError(f"{url} has more than {len(features)} features but does not support pagination")
+    else:
+        raise requests.HTTPError(f"{url} has more than {max_pages} pages of features")
+
+    # GeoJSON is always in WGS84
+    return gpd.GeoDataFrame.from_features(features, crs="EPSG:4326")
+
+
+def _supports_pagination(url):
+    info = _get_json(url.split('/query')[0], params={'f': 'json'}, timeout=10)
+    return info.get('advancedQueryCapabilities', {}).get('supportsPagination', False)
@@ -0,0 +1,220 @@
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import itertools
+import json
+import os
+import re
+import time
+
+import folium
+import geopandas as gpd
+import pandas as pd
+
+import cache
+import config
+import filters
+import mapping
+import marker_store
+
+# Static HTML maps of filter combinations without the dashboard. The manifest is a JSON file:
+#   {"data": {"table_types": ["ARRESTS"], "years": [2022], "spatial_join": false},
+#    "maps": [{"name": "patrol_area_white", "map_type": "Patrol Area", "races": ["WHITE"]}, ...],
+#    "grid": {"map_type": ["Patrol Area", "Individual Locations"], "ibrs": [["ALL"], ["13A: ASSAULT"]]}}
+# Filters (ibrs, statutes, races) are lists of values as in the dashboard URL and default to ["ALL"]. Maps are created
+# for each entry of maps and for each combination of the lists in grid. years defaults to all available years.
+# Maps are rendered in parallel by a pool of processes that each load the data once
+
+filter_names = ['ibrs', 'statutes', 'races']
+
+# Data of the worker process: partitions, spatial_join, markers, and the result of cache.get_data
+_worker = {}
+
+
+def filter_columns():
+    # Column of each filter of the manifest
+    return dict(zip(filter_names, cache.filter_columns()))
+
+
+def expand_manifest(manifest):
+    # List of maps (map_type, filters, and name) of the manifest
+    entries = list(manifest.get('maps', []))
+    if (grid:=manifest.get('grid')):
+        entries.extend(dict(zip(grid, x)) for x in itertools.product(*grid.values()))
+
+    maps = []
+    for entry in entries:
+        unknown = set(entry) - {'name', 'map_type'} - set(filter_names)
+        if unknown:
+            raise ValueError(f"Unknown manifest field(s) {sorted(unknown)} in {entry}")
+        if entry.get('map_type') not in config.geo_data:
+            raise ValueError(f"Unknown map type {entry.get('map_type')}. Map types are {list(config.geo_data)}")
+        x = {'map_type': entry['map_type']}
+        x.update({k:list(entry.get(k, ['ALL'])) for k in filter_names})
+        x['name'] = entry.get('name') or map_name(x)
+        maps.append(x)
+
+    names = [x['name'] for x in maps]
+    if (duplicates:=sorted({x for x in names if names.count(x)>1})):
+        raise ValueError(f"Map names must be unique: {duplicates}")
+    return maps
+
+
+def map_name(entry):
+    # File name of a map from its map type and filters. Long names are shortened with a hash of the entry
+    name = '_'.join([entry['map_type']] + ['+'.join(str(v) for v in entry[k]) for k in filter_names])
+    name = re.sub(r'[^A-Za-z0-9+]+', '_', name).strip('_')
+    return name if len(name)<=100 else name[:91] + '_' + cache.fingerprint(entry)[:8]
+
+
+def check_filters(index, maps):
+    # Values that are not in the data are ignored by filters.select, which would silently create the wrong map
+    for x in maps:
+        for k, col in filter_columns().items():
+            if (missing:=filters.missing_values(index, col, x[k])):
+                raise ValueError(f"{x['name']}: {k} {missing} are not in the data")
+
+
+def read_markers(path):
+    # Markers exported from the dashboard (Export Markers)
+    if not path:
+        return None
+    with open(path) as f:
+        return marker_store.read_export(json.load(f))
+
+
+def _init_worker(partitions, spatial_join, markers_path):
+    # Processes that are forked from the main process already have its data
+    if _worker.get('args')!=(partitions, spatial_join, markers_path):
+        _worker['args'] = (partitions, spatial_join, markers_path)
+        _worker['data'] = cache.get_data(partitions, spatial_join)
+        _worker['markers'] = read_markers(markers_path)
+
+
+def aggregate(map_type, df_rem, value_counts=None):
+    # Counts that are plotted on the map: the number of rows in each region or, for Individual Locations, the heat map
+    # cells (see mapping.heatmap_points). Returns a GeoDataFrame
+    # value_counts: number of selected rows with each value of the geographic unit (see mapping.region_counts)
+    layer = config.geo_data[map_type]
+    if map_type=='Individual Locations':
+        cells = mapping.heatmap_points(df_rem.geometry)
+        return gpd.GeoDataFrame({'Count': cells[:,2].astype(int)}, geometry=gpd.points_from_xy(cells[:,1], cells[:,0]),
+                                crs="EPSG:4326")
+
+    bounds = cache.load_geojson(layer['geojson']).drop_duplicates(subset=layer['bounds_on'])
+    keys = bounds[layer['bounds_on']].astype(str)
+    counts = mapping.region_counts(df_rem, layer['df_on'], keys, value_counts).fillna(0).astype(int)
+    return gpd.GeoDataFrame({map_type: keys.values, 'Count': counts.values}, geometry=bounds.geometry.values,
+                            crs=bounds.crs)
+
+
+def render_map(entry, out_dir, formats=('html',)):
+    # Renders a map of the manifest in the worker process. Returns the number of selected rows, the time of each step,
+    # and the size of each file written
+    df, _, index = _worker['data']
+    times = {}
+    t = time.perf_counter()
+    selections = {col:entry[k] for k, col in filter_columns().items()}
+    rows = filters.select(index, selections)
+    if entry['map_type']=='Individual Locations':
+        df_rem, value_counts = filters.take(df, rows), None
+    else:
+        # Regions are counted from the aggregate cube of the data, which each worker builds once for each map type
+        dataset = cache.dataset_key(*_worker['args'][:2], df)
+        df_rem = None
+        value_counts = cache.value_counts(dataset, filters.selection_key(index, selections), 
+                                          config.geo_data[entry['map_type']]['df_on'], index, df)
+    times['select'] = time.perf_counter() - t
+
+    t = time.perf_counter()
+    county_bounds = cache.get_county_bounds()
+    bounds = county_bounds.total_bounds
+    m = folium.Map(location=[(bounds[1]+bounds[3])/2, (bounds[0]+bounds[2])/2], zoom_start=10, min_zoom=10)
+    mapping.add_overlays(entry['map_type'], df_rem, m, config.geo_data, opacity=0.6, value_counts=value_counts,
+                         label=mapping.record_label(_worker['args'][0]))
+    if entry['map_type']=='Individual Locations':
+        mapping.add_county_boundary(county_bounds, m)
+    if _worker['markers'] is not None:
+        mapping.add_markers(m, *_worker['markers'])
+    folium.LayerControl().add_to(m)
+    times['build'] = time.perf_counter() - t
+
+    t = time.perf_counter()
+    html = m.get_root().render()
+    times['render'] = time.perf_counter() - t
+
+    t = time.perf_counter()
+    files = {}
+    path = os.path.join(out_dir, entry['name'])
+    if 'html' in formats:
+        with open(path+'.html', 'w', encoding='utf-8') as f:
+            f.write(html)
+        files[path+'.html'] = len(html)
+    if 'geojson' in formats or 'csv' in formats:
+        counts = aggregate(entry['map_type'], df_rem, value_counts)
+        if 'geojson' in formats:
+            counts.to_file(path+'.geojson', driver='GeoJSON')
+            files[path+'.geojson'] = os.path.getsize(path+'.geojson')
+        if 'csv' in formats:
+            if entry['map_type']=='Individual Locations':
+                table = pd.DataFrame({'Latitude': counts.geometry.y, 'Longitude': counts.geometry.x, 'Count': counts['Count']})
+            else:
+                table = pd.DataFrame(counts.drop(columns='geometry'))
+            table.to_csv(path+'.csv', index=False)
+            files[path+'.csv'] = os.path.getsize(path+'.csv')
+    times['write'] = time.perf_counter() - t
+
+    return {'name': entry['name'], 'rows': len(df) if rows is None else len(rows), 'seconds': times, 'files': files}
+
+
+def run(manifest, out_dir, formats=('html',), workers=None, markers_path=None):
+    data = manifest.get('data', {})
+    table_types = data.get('table_types', ['ARRESTS'])
+    available = cache.get_available_data()
+    partitions = tuple((t,y) for t in table_types for y in available.get(t, []) if 'years' not in data or y in data['years'])
+    if len(partitions)==0:
+        raise ValueError(f"No data is available for {table_types} {data.get('years', '')}")
+    spatial_join = data.get('spatial_join', config.spatial_join)
+
+    maps = expand_manifest(manifest)
+    os.makedirs(out_dir, exist_ok=True)
+
+    # The data is loaded (and stored) once here before the workers are started
+    t = time.perf_counter()
+    _init_worker(partitions, spatial_join, markers_path)
+    print(f"Loaded {len(_worker['data'][0]):,} rows of {partitions} in {time.perf_counter()-t:.2f} s")
+    check_filters(_worker['data'][2], maps)
+
+    t = time.perf_counter()
+    results = []
+    with ProcessPoolExecutor(max_workers=workers or config.load_workers, initializer=_init_worker,
+                             initargs=(partitions, spatial_join, markers_path)) as pool:
+        futures = [pool.submit(render_map, x, out_dir, formats) for x in maps]
+        for future in as_completed(futures):
+            result = future.result()
+            results.append(result)
+            print(f"{result['name']}: {result['rows']:,} rows, " +
+                  ', '.join(f"{k} {v:.2f} s" for k,v in result['seconds'].items()) +
+                  f", {sum(result['files'].values())/1e6:.2f} MB")
+    total = time.perf_counter() - t
+    print(f"Created {len(results)} maps in {total:.2f} s")
+
+    report = {'partitions': partitions, 'spatial_join': spatial_join, 'seconds': total,
+              'maps': sorted(results, key=lambda x: x['name'])}
+    with open(os.path.join(out_dir, 'report.json'), 'w') as f:
+        json.dump(report, f, indent=2)
+    return report
+
+
+if __name__=='__main__':
+    parser = argparse.ArgumentParser(description="Create static HTML maps of the filter combinations of a manifest")
+    parser.add_argument('manifest', help="JSON file of the data and maps to create (see batch.py)")
+    parser.add_argument('--out', default='maps', help="Output directory")
+    parser.add_argument('--formats', nargs='+', choices=['html', 'geojson', 'csv'], default=['html'],
+                        help="Files to write for each map. geojson and csv contain the counts that are plotted")
+    parser.add_argument('--workers', type=int, help="Number of processes (default: config.load_workers)")
+    parser.add_argument('--markers', help="Markers to add to each map (file from Export Markers)")
+    args = parser.parse_args()
+
+    with open(args.manifest) as f:
+        manifest = json.load(f)
+    run(manifest, args.out, args.formats, args.workers, args.markers)
@@ -0,0 +1,393 @@
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import folium
+from folium import plugins
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import pyproj
+import shapely
+from shapely.geometry import Point
+
+import cache
+import config
+import cube
+import encoding
+import filters
+import mapping
+import marker_store
+import spatial
+import store
+
+
+def synthetic_arrests(n, seed=0):
+    # Random arrests with coordinates inside Fairfax County and a realistic number of statutes and IBR codes
+    rng = np.random.default_rng(seed)
+    to_state_plane = pyproj.Transformer.from_crs("EPSG:4326", config.crs, always_xy=True)
+    x, y = to_state_plane.transform(rng.uniform(-77.45, -77.10, n), rng.uniform(38.65, 39.00, n))
+    # Some records are missing coordinates or have placeholder values
+    x[rng.random(n)<0.01] = np.nan
+    x[rng.random(n)<0.005] = 0
+
+    statutes = np.array([f"18.2-{k}" for k in range(400)], dtype=object)
+    statute_idx = np.minimum(rng.zipf(1.5, n), len(statutes)) - 1
+    ibr_codes = np.array([f"{k:02d}{c}" for k in range(10, 70) for c in 'AB'], dtype=object)
+    ibr_idx = statute_idx % len(ibr_codes)
+    races = np.array(['WHITE', 'BLACK', 'HISPANIC/LATINO', 'ASIAN', 'UNKNOWN'], dtype=object)
+    patrol_areas = np.array([str(k) for k in range(1, 60)] + ['UNVERIFIED'], dtype=object)
+
+    return pd.DataFrame({
+        'X Coordinate': x,
+        'Y Coordinate': y,
+        'Statute': statutes[statute_idx],
+        'Statute Description': np.char.add('DESCRIPTION OF STATUTE ', statute_idx.astype(str)).astype(object),
+        'IBR Code': ibr_codes[ibr_idx],
+        'IBR Description': np.char.add('IBR OFFENSE ', ibr_idx.astype(str)).astype(object),
+        'SUBJECT_RE_GROUP': races[rng.integers(0, len(races), n)],
+        'DISTRICT_1': rng.choice(['BRADDOCK', 'DRANESVILLE', 'HUNTER MILL', 'LEE', 'MASON'], n),
+        'Station Name': rng.choice(['FAIR OAKS', 'FRANCONIA', 'MASON', 'MCLEAN', 'RESTON'], n),
+        'Patrol Area': patrol_areas[rng.integers(0, len(patrol_areas), n)],
+        'ESZ (Emergency Service Zones)': rng.integers(100, 2000, n),
+        'DATE': pd.Timestamp('2022-01-01') + pd.to_timedelta(rng.integers(0, 365, n), unit='D'),
+    })
+
+
+def synthetic_points(n, seed=0):
+    rng = np.random.default_rng(seed)
+    return gpd.GeoSeries(shapely.points(rng.uniform(-77.45, -77.10, n), rng.uniform(38.65, 39.00, n)), crs="EPSG:4326")
+
+
+def synthetic_boundaries(seed=0):
+    # Boundaries of each geographic unit with the names used by synthetic_arrests. Each layer is a coverage of random
+    # (Voronoi) areas of the county with borders every ~30 m like the detailed borders of the real boundaries
+    rng = np.random.default_rng(seed)
+    county = shapely.box(-77.46, 38.64, -77.09, 39.01)
+    names = {
+        'Supervisor District': ['BRADDOCK', 'DRANESVILLE', 'HUNTER MILL', 'LEE', 'MASON'],
+        'Police District': ['FAIR OAKS', 'FRANCONIA', 'MASON', 'MCLEAN', 'RESTON'],
+        'Patrol Area': [str(k) for k in range(1, 60)],
+        'Emergency Service Zone': list(range(100, 2000)),
+    }
+    boundaries = {'county': gpd.GeoDataFrame({'NAME': ['Fairfax']}, geometry=[shapely.segmentize(county, 3e-4)], crs=4326)}
+    for name, values in names.items():
+        centers = shapely.MultiPoint(rng.uniform([-77.46, 38.64], [-77.09, 39.01], (len(values), 2)))
+        areas = shapely.intersection(shapely.get_parts(shapely.voronoi_polygons(centers, extend_to=county)), county)
+        boundaries[name] = gpd.GeoDataFrame({config.geo_data[name]['bounds_on']: values},
+                                            geometry=shapely.segmentize(areas, 3e-4), crs=4326)
+    return boundaries
+
+
+def legacy_preprocess(df):
+    # Row-wise implementation that cache.preprocess replaced
+    df['Patrol Area'] = df['Patrol Area'].apply(lambda x: int(x) if pd.notnull(x) and isinstance(x,str) and x.isdigit() else x)
+    df = gpd.GeoDataFrame(df)
+    df = df.set_geometry(df.apply(lambda x: Point(x['X Coordinate'], x['Y Coordinate']), axis=1),
+                                crs="EPSG:2283").to_crs(epsg=4326)
+    df['Statute Full'] = df.apply(lambda x: f"{x['Statute']}: {x['Statute Description']}", axis=1)
+    df['IBR Full'] = df.apply(lambda x: f"{x['IBR Code']}: {x['IBR Description']}", axis=1)
+    return df
+
+
+def legacy_select(df, selections):
+    # Copy and isin chain that filters.select replaced
+    df = df.copy()
+    for col, vals in selections.items():
+        if not any([x=='ALL' for x in vals]):
+            df = df[df[col].isin(vals)]
+    return df
+
+
+def legacy_options(df, col):
+    # value_counts of the selected rows that the options of the filter index replaced
+    vc = df[col].value_counts().to_frame().reset_index()
+    return [f'ALL ({len(df)})'] + vc.apply(lambda x: f"{x[col]} ({x['count']})", axis=1).to_list()
+
+
+def timeit(func, *args):
+    t = time.perf_counter()
+    result = func(*args)
+    return time.perf_counter() - t, result
+
+
+def bench_preprocess(sizes, legacy=True):
+    for n in sizes:
+        df = synthetic_arrests(n)
+        t_new, result = timeit(cache.preprocess, df.copy())
+        line = f"preprocess n={n:>9,}: vectorized {t_new:8.2f} s"
+        if legacy:
+            t_old, _ = timeit(legacy_preprocess, df.copy())
+            line += f", row-wise {t_old:8.2f} s, speedup {t_old/t_new:6.1f}x"
+        print(line)
+        print(f"    coordinates: {result.attrs['coordinates']}")
+
+
+def bench_spatial_join(sizes, boundary_file=None):
+    layer = config.geo_data['Emergency Service Zone']
+    if boundary_file:
+        bounds = gpd.read_file(boundary_file).to_crs(epsg=4326)
+    else:
+        bounds = cache.load_geojson(layer['geojson'])
+
+    for n in sizes:
+        points = synthetic_points(n)
+        t, regions = timeit(spatial.assign_regions, points, bounds, layer['bounds_on'])
+        print(f"spatial join n={n:>9,} points x {len(bounds)} ESZs: {t:8.2f} s ({n/t:,.0f} points/s), "+
+              f"{regions.notnull().sum():,} assigned")
+
+
+def _node_parse_times(json_text, encoded_text, repeat=5):
+    # Time parsing in JavaScript when node is available: JSON.parse of the point arrays versus decoding the compact encoding
+    if not shutil.which('node'):
+        return None
+    script = "var window = globalThis; var fs = require('fs');\n" + \
+        encoding.decode_points_js.replace('<script>', '').replace('</script>', '') + """
+        var jsonText = fs.readFileSync(process.argv[2], 'utf8'), encText = fs.readFileSync(process.argv[3], 'utf8');
+        function best(f) { var t = Infinity; for (var k = 0; k < %d; k++) { var t0 = performance.now(); f(); t = Math.min(t, performance.now()-t0); } return t/1000; }
+        console.log(JSON.stringify([best(function() { JSON.parse(jsonText); }), best(function() { fcpdDecodePoints(JSON.parse(encText)); })]));
+        """ % repeat
+    with tempfile.TemporaryDirectory() as d:
+        files = [os.path.join(d, x) for x in ['bench.js', 'points.json', 'encoded.json']]
+        for f, text in zip(files, [script, json_text, encoded_text]):
+            with open(f, 'w') as fp:
+                fp.write(text)
+        return json.loads(subprocess.run(['node'] + files, capture_output=True, text=True, check=True).stdout)
+
+
+def bench_encoding(sizes):
+    for n in sizes:
+        points = synthetic_points(n)
+        data = np.column_stack([points.y, points.x])
+
+        t_json, json_text = timeit(json.dumps, data.tolist())
+        t_enc, encoded = timeit(encoding.encode_points, data[:,0], data[:,1], None, 1e-5, True)
+        encoded_text = json.dumps(encoded)
+        t_json_parse, _ = timeit(json.loads, json_text)
+        t_dec, _ = timeit(lambda: encoding.decode_points(json.loads(encoded_text)))
+        print(f"points n={n:>9,}: JSON {len(json_text)/1e6:8.2f} MB, compact {len(encoded_text)/1e6:8.2f} MB "+
+              f"({len(json_text)/len(encoded_text):4.1f}x smaller)")
+        print(f"    python: encode JSON {t_json:6.3f} s, compact {t_enc:6.3f} s; parse JSON {t_json_parse:6.3f} s, compact {t_dec:6.3f} s")
+        if (node_times:=_node_parse_times(json_text, encoded_text)):
+            print(f"    javascript: parse JSON {node_times[0]:6.3f} s, compact {node_times[1]:6.3f} s")
+
+        html_size = []
+        for heat_map in [plugins.HeatMap, encoding.CompactHeatMap]:
+            m = folium.Map()
+            heat_map(data, radius=4, blur=1).add_to(m)
+            html_size.append(len(m.get_root().render()))
+        print(f"    map HTML: HeatMap {html_size[0]/1e6:8.2f} MB, CompactHeatMap {html_size[1]/1e6:8.2f} MB")
+
+
+def measure(func, setup=None, repeat=1, memory=True):
+    # Best time of repeat runs and the peak memory allocated (by Python and numpy, from tracemalloc) during 1 more run.
+    # setup: function that returns the arguments of func, which are not included in the time or memory
+    times = []
+    for _ in range(repeat):
+        args = setup() if setup else ()
+        t, result = timeit(func, *args)
+        times.append(t)
+    peak = None
+    if memory:
+        args = setup() if setup else ()
+        tracemalloc.start()
+        func(*args)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return min(times), peak, result
+
+
+def _use_fixtures(directory):
+    # Stores the synthetic boundaries in a new store in directory and reads data from CSV files in directory/source
+    # (see sources.LocalSource). Boundaries are never downloaded
+    config.store_dir = os.path.join(directory, 'store')
+    config.source_dir = os.path.join(directory, 'source')
+    config.offline = True
+    os.makedirs(config.source_dir)
+    for name, bounds in synthetic_boundaries().items():
+        store.write(('boundary', name), bounds)
+
+
+def _select_some(index, col, k):
+    # k most common values of col
+    col_index = index['columns'][col]
+    return [col_index['categories'][x] for x in np.argsort(-col_index['counts'], kind='stable')[:k]]
+
+
+def bench_suite(sizes, repeat=1, memory=True, legacy=True, log=print):
+    # Times the steps of a dashboard rerun on synthetic data. Returns a list of results
+    results = []
+    def run(name, n, func, setup=None, **info):
+        t, peak, result = measure(func, setup, repeat, memory)
+        results.append({'benchmark': name, 'size': n, 'seconds': t, 'peak_bytes': peak, **info})
+        log(f"{name:<32} n={n if n else '-':>9}: {t:8.3f} s" + (f", peak {peak/1e6:8.1f} MB" if peak is not None else ''))
+        return result
+
+    saved = (config.store_dir, config.source_dir, config.offline)
+    with tempfile.TemporaryDirectory() as d:
+        try:
+            _use_fixtures(d)
+            links = {k:v['geojson'] for k,v in config.geo_data.items() if 'geojson' in v}
+            for map_type in ['Patrol Area', 'Emergency Service Zone']:
+                layer = config.geo_data[map_type]
+                def boundary():
+                    cache.get_boundary_geojson.clear()
+                    return cache.get_boundary_geojson(links[map_type], layer['bounds_on'], (), config.boundary_zoom)
+                run(f"boundary geojson {map_type}", None, boundary, features=len(cache.load_geojson(links[map_type])))
+            county_bounds = cache.get_county_bounds()
+            center = county_bounds.geometry.iloc[0].centroid
+            markers = pd.DataFrame({'Name': [f'Marker {k}' for k in range(100)], 'Latitude': synthetic_points(100).y, 
+                                    'Longitude': synthetic_points(100).x, 'Group': 'Default Group', 'Color': 'Group Color'})
+            marker_groups = pd.DataFrame({'Name': ['Default Group'], 'Color': ['blue']})
+            many = synthetic_points(5000)
+            many_markers = pd.DataFrame({'Name': [f'Marker {k}' for k in range(5000)], 'Latitude': many.y, 
+                                         'Longitude': many.x, 'Group': 'Default Group', 'Color': 'Group Color'})
+            def marker_layers():
+                mapping.get_marker_layers.clear()
+                return mapping.get_marker_layers(many_markers, marker_groups)
+            run('marker layers', 5000, marker_layers)
+            run('import markers', 5000, marker_store.merge, lambda: (markers, marker_groups, [(many_markers, marker_groups)]))
+
+            for n in sizes:
+                raw = synthetic_arrests(n)
+                raw.to_csv(os.path.join(config.source_dir, 'ARRESTS_2022.csv'), index=False)
+                run('preprocess', n, cache.preprocess, lambda: (raw.copy(),))
+                partitions = (('ARRESTS', 2022),)
+                def unstored():
+                    path = store.key_to_path(("Fairfax County",)+partitions[0])
+                    for x in [path, path[:-len('.parquet')]+'.json']:
+                        if os.path.exists(x):
+                            os.remove(x)
+                    return ()
+                run('get_data (source)', n, lambda: cache.Dataset(partitions).get(), unstored)
+                df, _, index = run('get_data (stored)', n, lambda: cache.Dataset(partitions).get())
+                dataset = cache.dataset_key(partitions, False, df)
+
+                ibrs = _select_some(index, 'IBR Full', 5)
+                selections = {'IBR Full': ibrs, 'Statute Full': ['ALL'], 
+                              cache.columns().RE_GROUP_SUBJECT: _select_some(index, cache.columns().RE_GROUP_SUBJECT, 2)}
+                rows = run('select', n, filters.select, lambda: (index, selections))
+                if legacy:
+                    run('select (isin chain)', n, legacy_select, lambda: (df, selections))
+
+                def options():
+                    for f in [cache.get_ibr_options, cache.get_statute_options]:
+                        f.clear()
+                    return cache.get_ibr_options(dataset, index), \
+                        cache.get_statute_options(dataset, filters.selection_key(index, {'IBR Full': ibrs}), index)
+                # The cube of the filter columns is built once per dataset
+                run('build cube', n, lambda: cache.get_cube.__wrapped__(dataset, None, index))
+                run('get_*_options', n, options)
+                if legacy:
+                    run('get_*_options (value_counts)', n, lambda: (legacy_options(df, 'IBR Full'), 
+                        legacy_options(legacy_select(df, {'IBR Full': ibrs}), 'Statute Full')))
+
+                df_rem = filters.take(df, rows)
+                selection = filters.selection_key(index, selections)
+                for map_type in ['Patrol Area', 'Emergency Service Zone']:
+                    df_on = config.geo_data[map_type]['df_on']
+                    data_cube = run(f"build cube {map_type}", n, lambda: cache.get_cube.__wrapped__(dataset, df_on, index, df))
+                    run(f"value_counts {map_type}", n, lambda: cube.value_counts(data_cube, df_on, selection), cells=len(data_cube['counts']))
+                    if legacy:
+                        run(f"value_counts {map_type} (rows)", n, lambda: filters.take(df, rows)[df_on].value_counts())
+                new_map = lambda: (folium.Map(location=[center.y, center.x], zoom_start=10),)
+                for map_type in ['Patrol Area', 'Emergency Service Zone']:
+                    layer = config.geo_data[map_type]
+                    run(f"Choropleth {map_type}", n, lambda m: mapping.Choropleth(m, layer['geojson'], df_rem, layer['bounds_on'],
+                        layer['df_on'], 'Arrests', [f'{map_type}:','# of Arrests: ']), new_map)
+                run('add_overlays heat map', n, lambda m: mapping.add_overlays('Individual Locations', df_rem, m, 
+                                                                              config.geo_data, None), new_map)
+
+                for map_type in ['Emergency Service Zone', 'Individual Locations']:
+                    def build(map_type=map_type):
+                        m = new_map()[0]
+                        mapping.add_overlays(map_type, df_rem, m, config.geo_data, 0.6)
+                        mapping.add_county_boundary(county_bounds, m)
+                        mapping.add_markers(m, markers, marker_groups)
+                        folium.LayerControl().add_to(m)
+                        return m
+                    html = run(f"render {map_type}", n, lambda: build().get_root().render())
+                    results[-1]['html_bytes'] = len(html)
+                    # Each run of the miss has a new key
+                    run(f"map_to_html {map_type} (miss)", n, lambda key: cache.map_to_html(key, build), 
+                        lambda: (cache.fingerprint('benchmark', n, map_type, time.perf_counter_ns()),))
+                    key = cache.fingerprint('benchmark', n, map_type)
+                    cache.map_to_html(key, build)
+                    run(f"map_to_html {map_type} (hit)", n, lambda: cache.map_to_html(key, build))
+        finally:
+            config.store_dir, config.source_dir, config.offline = saved
+    return results
+
+
+def _meta():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, 
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'commit': commit,
+        'python': sys.version.split()[0],
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'versions': {m.__name__: m.__version__ for m in [np, pd, gpd, shapely, folium]},
+    }
+
+
+def compare(results, baseline, threshold, min_seconds=0.01):
+    # Results that are more than threshold times slower than in baseline (results of a previous run). Steps that
+    # take less than min_seconds are too noisy to compare
+    before = {(x['benchmark'], x['size']): x['seconds'] for x in baseline['results']}
+    return [{**x, 'baseline_seconds': before[k]} for x in results 
+            if (k:=(x['benchmark'], x['size'])) in before and x['seconds'] > max(threshold*before[k], min_seconds)]
+
+
+if __name__=='__main__':
+    default_sizes = {'preprocess': [100_000, 1_000_000, 5_000_000], 'spatial-join': [1_000_000, 2_000_000, 5_000_000],
+                     'encoding': [10_000, 100_000, 1_000_000], 'suite': [10_000, 100_000, 1_000_000]}
+    parser = argparse.ArgumentParser(description="Benchmark dashboard data processing on synthetic data")
+    parser.add_argument('benchmark', choices=default_sizes.keys())
+    parser.add_argument('--sizes', type=int, nargs='+')
+    parser.add_argument('--no-legacy', action='store_true', help="Skip the row-wise implementation in preprocess (slow for large sizes)")
+    parser.add_argument('--boundary', help="GeoJSON file of the ESZ boundaries for spatial-join. Defaults to the stored or downloaded layer")
+    parser.add_argument('--repeat', type=int, default=3, help="suite: number of runs of each step (the best time is reported)")
+    parser.add_argument('--no-memory', action='store_true', help="suite: skip the run that measures peak memory")
+    parser.add_argument('--output', help="suite: JSON file of the results. Results are written to stdout by default")
+    parser.add_argument('--baseline', help="suite: JSON file of previous results. Exits with an error if a step is slower")
+    parser.add_argument('--threshold', type=float, default=1.5, help="suite: ratio to the baseline time that is a regression")
+    args = parser.parse_args()
+    sizes = args.sizes or default_sizes[args.benchmark]
+
+    if args.benchmark=='suite':
+        # Progress is written to stderr so that stdout only contains the results
+        results = bench_suite(sizes, args.repeat, not args.no_memory, not args.no_legacy, 
+                              log=lambda x: print(x, file=sys.stderr))
+        report = {'meta': _meta(), 'results': results}
+        if args.output:
+            with open(args.output, 'w') as f:
+                json.dump(report, f, indent=2)
+        else:
+            print(json.dumps(report, indent=2))
+        if args.baseline:
+            with open(args.baseline) as f:
+                regressions = compare(results, json.load(f), args.threshold)
+            for x in regressions:
+                print(f"Regression: {x['benchmark']} n={x['size']} {x['seconds']:.3f} s (baseline {x['baseline_seconds']:.3f} s)",
+                      file=sys.stderr)
+            if regressions:
+                sys.exit(1)
+    elif args.benchmark=='preprocess':
+        bench_preprocess(sizes, legacy=not args.no_legacy)
+    elif args.benchmark=='spatial-join':
+        bench_spatial_join(sizes, args.boundary)
+    else:
+        bench_encoding(sizes)
@@ -1,72 +1,482 @@
-import folium
-from folium import plugins
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import functools
 import geopandas as gpd
+import hashlib
+import itertools
+import numpy as np
 import pandas as pd
-import openpolicedata as opd
-from shapely.geometry import Point
-import streamlit as st
+import shapely
+import sys
+import threading
+import time
 
-from config import geo_data
+import arcgis
+import caching
+from caching import fingerprint
+import config
+from config import crs, geo_data
+import cube
+import filters
+import sources
+import spatial
+import store
+import timing
+import topology
 
-def hash_df(df: gpd.GeoDataFrame):
-    return pd.util.hash_pandas_object(df)
+def _options(index, col, counts):
+    # "value (count)" of each value with rows, with the most common first, after "ALL (total)"
+    # counts: number of rows with each value of col (in the order of the index categories)
+    categories = index['columns'][col]['categories']
+    keep = np.flatnonzero((counts>0) & pd.notnull(categories))
+    keep = keep[np.argsort(-counts[keep], kind='stable')]
+    labels = categories[keep].astype(str) + ' (' + pd.Index(counts[keep]).astype(str) + ')'
+    options = [f'ALL ({counts.sum()})']
+    options.extend(labels)
+    return options
 
 
-@st.cache_data(show_spinner=False, hash_funcs={gpd.GeoDataFrame: hash_df})
-def get_statute_options(df):
-    vc = df['Statute Full'].value_counts().to_frame().reset_index()
-    vc = vc.apply(lambda x: f"{x['Statute Full']} ({x['count']})", axis=1)
-    vc = vc.to_list()
-    options = [f'ALL ({len(df)})']
-    options.extend(vc)
-    return options
+# Options are identified by the dataset and the selected IBR codes (see filters.selection_key) instead of hashing the data.
+# Statute counts are summed from the aggregate cube of the filter columns instead of the rows of the selected IBR codes
+@caching.cache_data(show_spinner=False)
+def get_statute_options(dataset, ibr_selection, _index):
+    return _options(_index, 'Statute Full', cube.counts(get_cube(dataset, None, _index), 'Statute Full', ibr_selection))
 
-@st.cache_data(show_spinner=False, hash_funcs={gpd.GeoDataFrame: hash_df})
-def get_ibr_options(df):
-    vc = df['IBR Full'].value_counts().to_frame().reset_index()
-    vc = vc.apply(lambda x: f"{x['IBR Full']} ({x['count']})", axis=1)
-    vc = vc.to_list()
-    options = [f'ALL ({len(df)})']
-    options.extend(vc)
-    return options
+@caching.cache_data(show_spinner=False)
+def get_ibr_options(dataset, _index):
+    return _options(_index, 'IBR Full', filters.counts(_index, 'IBR Full'))
 
 
-@st.cache_data(show_spinner=False)
-def map_to_html(plot_dual, map_type, ibrs, statutes, races, _m):
-    return _m.get_root().render()
+# Aggregate cubes (see cube.py) are identified by the dataset like the options
+@caching.cache_resource(show_spinner=False, max_entries=config.cube_cache_entries)
+def get_cube(dataset, column, _index, _df=None):
+    # Cube of the filter columns and column (a geographic unit of the data or None for only the filter columns)
+    return cube.build(_index, filter_columns() + ([column] if column else []), _df)
 
 
-@st.cache_data(show_spinner="Loading boundaries")
-def load_geojson(geojson_link):
-    bounds = gpd.read_file(geojson_link)
+def value_counts(dataset, selection, column, index, df):
+    # Number of rows of a selection (selection key) with each value of column (like df[column].value_counts() of the
+    # selected rows) from the cube of the dataset
+    return cube.value_counts(get_cube(dataset, column, index, df), column, selection)
+
+
+class LRUCache:
+    # Least recently used cache that is shared by all sessions. Entries are evicted when their total size (from sizeof)
+    # exceeds max_bytes
+    def __init__(self, max_bytes, sizeof=sys.getsizeof):
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, create):
+        # Returns the cached value for key or calls create to make it
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                timing.annotate(cache='hit')
+                return self._entries[key][0]
+            self.misses += 1
+        timing.annotate(cache='miss')
+
+        # Other sessions can use the cache while the value is created
+        value = create()
+        size = self.sizeof(value)
+        with self._lock:
+            if key in self._entries:
+                # Another session created it first
+                return self._entries[key][0]
+            elif size>self.max_bytes:
+                return value
+            self._entries[key] = (value, size)
+            self.nbytes += size
+            while self.nbytes>self.max_bytes:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self.nbytes -= evicted_size
+        return value
+
+    def stats(self):
+        with self._lock:
+            return {'entries': len(self._entries), 'bytes': self.nbytes, 'hits': self.hits, 'misses': self.misses}
+
+
+@caching.cache_resource(show_spinner=False)
+def _selection_cache():
+    return LRUCache(config.selection_cache_bytes, sizeof=lambda rows: sys.getsizeof(rows) if rows is None else rows.nbytes)
+
+
+def get_selection(dataset, selection, index, selections):
+    # Row positions of a filter selection (see filters.select) that are shared by all sessions. Selections are identified
+    # by the dataset and their selection key (filters.selection_key) so that equivalent selections share their rows.
+    # The rows are read-only because they are shared
+    def create():
+        rows = filters.select(index, selections)
+        if rows is not None:
+            rows.flags.writeable = False
+        return rows
+    with timing.span('get_selection'):
+        rows = _selection_cache().get((dataset, selection), create)
+        timing.annotate(rows=index['n'] if rows is None else len(rows))
+    return rows
+
+
+def cache_stats():
+    # Size and hits/misses of the caches that are shared by all sessions
+    return {'render': _render_cache().stats(), 'selection': _selection_cache().stats()}
+
+
+@caching.cache_resource
+def _render_cache():
+    return LRUCache(config.render_cache_bytes)
+
+
+def map_to_html(key, build):
+    # key: fingerprint of all inputs of the map (see fingerprint)
+    # build: function that returns the map. It is only called (and rendered) when the page is not cached
+    def create():
+        with timing.span('build map'):
+            m = build()
+        with timing.span('render map'):
+            return m.get_root().render()
+    with timing.span('map_to_html'):
+        html = _render_cache().get(key, create)
+        timing.annotate(bytes=len(html))
+    return html
+
+
+@caching.cache_data(show_spinner=False)
+def get_boundary_geojson(geojson_link, bounds_on, exclude=(), zoom=None):
+    # Boundaries are serialized once per layer. Features are identified by the value of bounds_on
+    # If zoom is given, the geometries are simplified for the zoom level and returned separately as a topology (see
+    # topology.from_zoom). Returns the features (GeoJSON), topology (or None), and feature IDs
+    bounds = load_geojson(geojson_link)
+    if len(exclude)>0:
+        bounds = bounds[~bounds[bounds_on].isin(exclude)]
+    bounds = bounds.drop_duplicates(subset=bounds_on)
+    keys = bounds[bounds_on].astype(str)
+    if zoom is None:
+        return gpd.GeoSeries(bounds['geometry'].values, index=keys).to_json(), None, keys.tolist()
+    return *topology.from_zoom(bounds['geometry'].values, keys, zoom), keys.tolist()
+
+
+county_link = 'https://services1.arcgis.com/ioennV6PpG5Xodq0/arcgis/rest/services/Fairfax_County_Boundary/FeatureServer/0/query?outFields=*&where=1%3D1&f=geojson'
+
+def _read_boundary(geojson_link):
+    bounds = arcgis.read_features(geojson_link) if arcgis.is_feature_query(geojson_link) else gpd.read_file(geojson_link)
     return bounds.to_crs(epsg=4326)
 
 
-@st.cache_data(show_spinner="Fetching data")
-def get_data(table_type, year):
-    data = opd.Source(source_name="Fairfax County")
-    table = data.load(year=year, table_type=table_type)
-    table.standardize()
-    df = table.table
-    df['Patrol Area'] = df['Patrol Area'].apply(lambda x: int(x) if pd.notnull(x) and isinstance(x,str) and x.isdigit() else x)
+def load_boundary(name, geojson_link):
+    # The last edit date of ArcGIS layers is used to check whether a stored copy is out of date
+    return store.load(('boundary', name), lambda: _read_boundary(geojson_link), ttl=config.boundary_ttl,
+                      version=lambda: arcgis.last_edit(geojson_link) if arcgis.is_feature_query(geojson_link) else None)
+
+
+def boundary_links():
+    # Dictionary of name: link of all boundaries used by the dashboard
+    links = {k:v['geojson'] for k,v in geo_data.items() if 'geojson' in v}
+    links['county'] = county_link
+    return links
+
+
+def boundary_name(geojson_link):
+    name = [k for k,v in boundary_links().items() if v==geojson_link]
+    return name[0] if name else hashlib.sha1(geojson_link.encode()).hexdigest()[:16]
+
+
+@caching.cache_resource(show_spinner=False)
+def _prefetch_boundaries():
+    links = boundary_links()
+    pool = ThreadPoolExecutor(max_workers=len(links))
+    futures = {v:pool.submit(load_boundary, k, v) for k,v in links.items()}
+    pool.shutdown(wait=False)
+    return futures
+
+
+def prefetch_boundaries():
+    # Starts loading all boundaries concurrently in the background (once per server) so that they are
+    # usually ready before they are first needed
+    _prefetch_boundaries()
+
+
+@caching.cache_resource(show_spinner=False)
+def _load_geojson(geojson_link):
+    return load_boundary(boundary_name(geojson_link), geojson_link)
+
 
-    df = gpd.GeoDataFrame(df)
+def load_geojson(geojson_link):
+    # Boundaries are shared by all sessions and must not be modified
+    future = _prefetch_boundaries().get(geojson_link)
+    with caching.spinner("Loading boundaries"):
+        if future is None or future.exception() is not None:
+            # Load again if the prefetch failed
+            return _load_geojson(geojson_link)
+        return future.result()
+
+
+@functools.lru_cache
+def _to_wgs84():
+    import pyproj
+    return pyproj.Transformer.from_crs(crs, "EPSG:4326", always_xy=True)
+
+
+def points_from_coordinates(df, x_col='X Coordinate', y_col='Y Coordinate'):
     # This reference https://law.lis.virginia.gov/vacodefull/title1/chapter6/ describes the Virginia State Plane North (NAD83) projection
     # The Virginia State Plane is referenced as EPSG:2283 NAD83 / Virginia North (ftUS) in https://epsg.io/2283
-    df = df.set_geometry(df.apply(lambda x: Point(x['X Coordinate'], x['Y Coordinate']), axis=1),
-                                crs="EPSG:2283").to_crs(epsg=4326)
-    
-    df['Statute Full'] = df.apply(lambda x: f"{x['Statute']}: {x['Statute Description']}", axis=1)
-    df['IBR Full'] = df.apply(lambda x: f"{x['IBR Code']}: {x['IBR Description']}", axis=1)
+    if x_col not in df or y_col not in df:
+        # Table types without coordinates (all locations are missing)
+        geometry = gpd.GeoSeries(np.full(len(df), None, dtype=object), index=df.index, crs="EPSG:4326")
+        return geometry, {'total': len(df), 'kept': 0, 'null': len(df), 'invalid': 0}
+
+    x = pd.to_numeric(df[x_col], errors='coerce').to_numpy(dtype=float)
+    y = pd.to_numeric(df[y_col], errors='coerce').to_numpy(dtype=float)
+    null = (df[x_col].isnull() | df[y_col].isnull()).to_numpy()
+
+    lon, lat = _to_wgs84().transform(x, y)
+    # Coordinates that are non-numeric or that land outside of the area covered by the projection
+    # (i.e. placeholder values such as 0) cannot be placed on the map
+    area = _to_wgs84().source_crs.area_of_use.bounds
+    valid = (lon>=area[0]) & (lon<=area[2]) & (lat>=area[1]) & (lat<=area[3])
+
+    geometry = np.full(len(df), None, dtype=object)
+    geometry[valid] = shapely.points(lon[valid], lat[valid])
+    geometry = gpd.GeoSeries(geometry, index=df.index, crs="EPSG:4326")
+
+    stats = {'total': len(df), 'kept': int(valid.sum()), 'null': int(null.sum()), 
+             'invalid': int((~valid & ~null).sum())}
+    return geometry, stats
+
+
+def patrol_area_to_int(pa):
+    if pa.dtype==object:
+        is_num = pa.str.isdigit().eq(True)
+        pa = pa.where(~is_num, pd.to_numeric(pa[is_num]).astype(object))
+    return pa
 
-    cols_keeps = ['Statute Full', 'IBR Full', 'geometry', opd.defs.columns.RE_GROUP_SUBJECT]
+
+def preprocess(df):
+    if 'Patrol Area' in df:
+        df['Patrol Area'] = patrol_area_to_int(df['Patrol Area'])
+
+    geometry, stats = points_from_coordinates(df)
+    df = gpd.GeoDataFrame(df, geometry=geometry)
+    # Rows without valid coordinates are kept since they are still counted in the geographic units
+    # that come with the data. They are only missing from the heat map
+    df.attrs['coordinates'] = stats
+
+    df['Statute Full'] = _label(df, 'Statute', 'Statute Description')
+    df['IBR Full'] = _label(df, 'IBR Code', 'IBR Description')
+
+    cols_keeps = ['Statute Full', 'IBR Full', 'geometry', columns().RE_GROUP_SUBJECT, columns().DATE]
     cols_keeps.extend([x['df_on'] for x in geo_data.values() if 'df_on' in x])
-    df = df[cols_keeps]
-    return df, df[opd.defs.columns.RE_GROUP_SUBJECT].unique()
+    # Table types other than arrests may not have all of the columns
+    for col in cols_keeps:
+        if col not in df:
+            df[col] = None
+    return df[cols_keeps]
+
+
+def _label(df, code, description):
+    if code not in df and description not in df:
+        return pd.Categorical([None]*len(df))
+    return (df.get(code, pd.Series(None, index=df.index)).astype(str) + ': ' + 
+            df.get(description, pd.Series(None, index=df.index)).astype(str)).astype('category')
+
+
+def columns():
+    # Standard column names (openpolicedata.defs.columns). openpolicedata is slow to import so it is only imported
+    # when it is needed
+    import openpolicedata as opd
+    return opd.defs.columns
+
+
+def get_source():
+    return sources.LocalSource(config.source_dir) if config.source_dir else sources.OpdSource("Fairfax County")
+
+
+def fetch_data(table_type, year):
+    return preprocess(get_source().load(table_type, year))
+
+
+def _row_hashes(df):
+    cols = {k:df[k] for k in df.columns if k!='geometry'}
+    cols['x'] = df.geometry.x
+    cols['y'] = df.geometry.y
+    return pd.util.hash_pandas_object(pd.DataFrame(cols), index=False)
+
+
+def update_partition(table_type, year, stored):
+    # Appends the records of the source that are newer than the stored ones (the watermark). Returns None if the stored
+    # data does not have dates
+    date = columns().DATE
+    if date not in stored or stored[date].isnull().all():
+        return None
+
+    watermark = pd.Timestamp(stored[date].max()).normalize()
+    raw = get_source().load(table_type, year, start=watermark.strftime('%Y-%m-%d'))
+    new = preprocess(raw)
+    # Records from the day of the watermark may already be stored. Identical records are counted so that
+    # duplicate records in the source are still added
+    hashes = _row_hashes(new)
+    stored_counts = _row_hashes(stored[stored[date]>=watermark]).value_counts()
+    is_new = (hashes.groupby(hashes).cumcount() >= hashes.map(stored_counts).fillna(0)).to_numpy()
+    if not is_new.any():
+        return stored
+
+    new = new[is_new]
+    new.attrs['coordinates'] = points_from_coordinates(raw[is_new])[1]
+    return concat_partitions([stored, new])
+
+
+def filter_columns():
+    return ['IBR Full', 'Statute Full', columns().RE_GROUP_SUBJECT]
+
+
+@caching.cache_data(show_spinner=False, ttl=config.data_ttl)
+def get_available_data():
+    # Years available for each table type. Only stored data is available if the list of datasets
+    # cannot be loaded (i.e. offline)
+    available = {}
+    source = get_source()
+    if not (config.offline and source.remote):
+        try:
+            available = source.years()
+        except Exception:
+            available = {}
+
+    for key in store.stored_keys():
+        if len(key)==3 and key[0]=="Fairfax County" and key[2] not in available.setdefault(key[1], []):
+            available[key[1]].append(key[2])
+    return {k:sorted(v) for k,v in sorted(available.items())}
+
+
+def get_regions(key, df, layers):
+    # Geographic units of each arrest from its location instead of the values in the data. The result is stored next to the
+    # dataset and recomputed when the dataset or any of the boundaries are updated
+    # layers: dictionary of column: (boundaries, bounds_on) (see spatial.join_regions)
+    def version():
+        keys = [key] + [('boundary', k) for k,v in geo_data.items() if 'geojson' in v]
+        return [store.read_meta(store.key_to_path(k)).get('saved') for k in keys]
+
+    return store.load(key+('regions',), lambda: spatial.join_regions(df.geometry, layers), ttl=0, version=version, remote=False)
+
+
+def load_partition(table_type, year, regions=None):
+    key = ("Fairfax County", table_type, year)
+    df = store.load(key, lambda: fetch_data(table_type, year), ttl=config.data_ttl, remote=get_source().remote,
+                    update=lambda stored: update_partition(table_type, year, stored))
+    # Numeric patrol areas are stored as text
+    df['Patrol Area'] = patrol_area_to_int(df['Patrol Area'])
+    if regions:
+        regions = get_regions(key, df, regions)
+        for col in regions.columns:
+            df[col] = regions[col]
+    df['Table Type'] = pd.Categorical([table_type]*len(df))
+    df['Year'] = np.full(len(df), year, dtype=np.int16)
+    return df
+
+
+def concat_partitions(parts):
+    # Categorical columns are given the same categories first since concat converts categoricals
+    # with different categories to object
+    parts = [x.copy(deep=False) for x in parts]
+    for col in parts[0].columns:
+        if any(isinstance(x[col].dtype, pd.CategoricalDtype) for x in parts):
+            # Empty columns are not categorical when read from the store
+            values = [x[col].astype('category') for x in parts]
+            categories = values[0].cat.categories.append([v.cat.categories for v in values[1:]]).unique()
+            for x, v in zip(parts, values):
+                x[col] = v.cat.set_categories(categories)
+
+    df = pd.concat(parts, ignore_index=True)
+    df.attrs['coordinates'] = {k:sum(x.attrs['coordinates'][k] for x in parts) for k in parts[0].attrs['coordinates']}
+    return df
+
+
+# Versions of the tables of all Datasets (see dataset_key)
+_versions = itertools.count(1)
+
+
+class Dataset:
+    # Combined table of partitions (tuple of the (table type, year) of each dataset) and its filter index that is shared
+    # by all sessions. The partitions are loaded in parallel and combined into 1 table with the partition of each row in
+    # the Table Type and Year columns. After data_ttl, records that were appended to the stored partitions
+    # (see update_partition) are appended to the table and index instead of rebuilding them. The table is rebuilt when a
+    # stored partition was replaced or its geographic units were assigned again (spatial join with new boundaries).
+    # Each new table gets a new version (attrs['version'])
+    def __init__(self, partitions, spatial_join=False):
+        self.partitions = partitions
+        self.spatial_join = spatial_join
+        self._value = None
+        self._loaded = None
+        self._checked = None
+        self._lock = threading.Lock()
+
+    def _load_partitions(self):
+        regions = {v['df_on']:(load_geojson(v['geojson']), v['bounds_on']) for v in geo_data.values() if 'geojson' in v} \
+            if self.spatial_join else None
+        with ThreadPoolExecutor(max_workers=max(1, min(config.load_workers, len(self.partitions)))) as pool:
+            parts = list(pool.map(lambda x: load_partition(*x, regions), self.partitions))
+        meta = [store.read_meta(store.key_to_path(("Fairfax County",)+x)) for x in self.partitions]
+        regions = [store.read_meta(store.key_to_path(("Fairfax County",)+x+('regions',))).get('saved') if self.spatial_join
+                   else None for x in self.partitions]
+        return parts, [{'rows':len(x), 'saved':m.get('saved'), 'appended':m.get('appended'), 'regions':r} 
+                       for x,m,r in zip(parts, meta, regions)]
+
+    def get(self):
+        # Returns the table, its unique races, and its filter index. The returned table must not be modified
+        with self._lock:
+            if self._value is not None and time.time()-self._checked < config.data_ttl:
+                timing.annotate(cache='hit')
+                return self._value
+            timing.annotate(cache='miss' if self._value is None else 'refresh')
+
+            parts, loaded = self._load_partitions()
+            if self._value is None or \
+                any(x['saved']!=y['saved'] and x['appended']!=y['rows'] or x['regions']!=y['regions']
+                    for x,y in zip(loaded, self._loaded)):
+                df = concat_partitions(parts)
+                df.attrs['version'] = next(_versions)
+                index = filters.build_index(df, filter_columns())
+            else:
+                df, _, index = self._value
+                new = [p.iloc[y['rows']:] for p,y in zip(parts, self._loaded) if len(p)>y['rows']]
+                if len(new)>0:
+                    n = len(df)
+                    df = concat_partitions([df]+new)
+                    # The new rows have the attributes of their whole partition
+                    df.attrs['coordinates'] = {k:sum(x.attrs['coordinates'][k] for x in parts) for k in parts[0].attrs['coordinates']}
+                    df.attrs['version'] = next(_versions)
+                    index = filters.append_index(index, df, n)
+
+            self._value = (df, df[columns().RE_GROUP_SUBJECT].unique(), index)
+            self._loaded = loaded
+            self._checked = time.time()
+            return self._value
+
+
+@caching.cache_resource(show_spinner=False)
+def _get_dataset(partitions, spatial_join):
+    return Dataset(partitions, spatial_join)
+
+
+def dataset_key(partitions, spatial_join, df):
+    # Key of a version of a dataset (the table returned by get_data) that identifies everything cached for it (i.e. options,
+    # cubes, selected rows, and rendered layers)
+    return (partitions, spatial_join, df.attrs['version'])
+
+
+def get_data(partitions, spatial_join=False):
+    # See Dataset
+    with caching.spinner("Fetching data"), timing.span('get_data', partitions=partitions, spatial_join=spatial_join):
+        data = _get_dataset(partitions, spatial_join).get()
+        timing.annotate(rows=len(data[0]))
+        return data
 
 
-@st.cache_data(show_spinner="Loading County Boundary")
 def get_county_bounds():
-    geojson_link = 'https://services1.arcgis.com/ioennV6PpG5Xodq0/arcgis/rest/services/Fairfax_County_Boundary/FeatureServer/0/query?outFields=*&where=1%3D1&f=geojson'
-    fairfax_county_boundary = gpd.read_file(geojson_link)
-    return fairfax_county_boundary.to_crs(epsg=4326)
+    return load_geojson(county_link)
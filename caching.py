@@ -0,0 +1,116 @@
+from collections import OrderedDict
+import contextlib
+import functools
+import hashlib
+import inspect
+import pickle
+import threading
+import time
+
+import pandas as pd
+
+import timing
+
+# Caching of the data and rendering functions (cache.py, mapping.py) without depending on Streamlit. By default, results
+# are kept in memory in this process (i.e. for scripts such as batch.py). The dashboard replaces the backend with
+# Streamlit's caches (streamlit_utils.use_streamlit) before any cached function is called. As in Streamlit, cache_data
+# returns a copy of the result, cache_resource returns the shared result, and arguments starting with _ are not hashed.
+
+_backend = None
+_spinner = lambda text: contextlib.nullcontext()
+_lock = threading.Lock()
+
+
+def set_backend(backend, spinner=None):
+    # backend: function(kind ('data' or 'resource'), func, options) that returns the cached function
+    # spinner: function(text) that returns a context manager shown while slow results are loaded
+    global _backend, _spinner
+    _backend = backend
+    if spinner:
+        _spinner = spinner
+
+
+def spinner(text):
+    return _spinner(text)
+
+
+def fingerprint(*parts):
+    # Short hash of everything that affects a cached result. Tables (i.e. markers) are hashed by their content
+    h = hashlib.sha1()
+    for x in parts:
+        if isinstance(x, pd.DataFrame):
+            h.update(repr(x.columns.tolist()).encode())
+            h.update(pd.util.hash_pandas_object(x).values.tobytes())
+        else:
+            h.update(repr(x).encode())
+    return h.hexdigest()
+
+
+class _MemoryCache:
+    # Results of func in this process. Only 1 result is created at a time for each function so that shared resources
+    # (i.e. thread pools and datasets) are only created once
+    def __init__(self, kind, func, options):
+        self.func = func
+        self.copy = kind=='data'
+        self.ttl = options.get('ttl')
+        self.max_entries = options.get('max_entries')
+        self.signature = inspect.signature(func)
+        self._entries = OrderedDict()
+        self._lock = threading.RLock()
+
+    def __call__(self, *args, **kwargs):
+        bound = self.signature.bind(*args, **kwargs)
+        bound.apply_defaults()
+        key = fingerprint(*[x for k,v in bound.arguments.items() if not k.startswith('_') for x in (k,v)])
+        with self._lock:
+            if key in self._entries and (self.ttl is None or time.time()-self._entries[key][0] < self.ttl):
+                self._entries.move_to_end(key)
+                value = self._entries[key][1]
+            else:
+                value = self.func(*args, **kwargs)
+                if self.copy:
+                    value = pickle.dumps(value)
+                self._entries[key] = (time.time(), value)
+                if self.max_entries and len(self._entries)>self.max_entries:
+                    self._entries.popitem(last=False)
+        return pickle.loads(value) if self.copy else value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+def _cached(kind, func, options):
+    if func is None:
+        return lambda f: _cached(kind, f, options)
+
+    # The backend is chosen when the function is first called so that it can be set after the modules are imported.
+    # Each call of a public function is a timing span that records whether the result was cached
+    traced = not func.__name__.startswith('_')
+    @functools.wraps(func)
+    def compute(*args, **kwargs):
+        if traced:
+            timing.annotate(cache='miss')
+        return func(*args, **kwargs)
+
+    cached = []
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not cached:
+            with _lock:
+                if not cached:
+                    cached.append((_backend or _MemoryCache)(kind, compute, options))
+        with timing.span(func.__name__, cache='hit') if traced else contextlib.nullcontext():
+            return cached[0](*args, **kwargs)
+
+    wrapper.clear = lambda: cached[0].clear() if cached else None
+    return wrapper
+
+
+def cache_data(func=None, **options):
+    # options: ttl (seconds), max_entries, and options of the backend (i.e. show_spinner)
+    return _cached('data', func, options)
+
+
+def cache_resource(func=None, **options):
+    return _cached('resource', func, options)
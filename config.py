@@ -1,3 +1,5 @@
+import os
+
 geo_data = {
     'Supervisor District': {
         'geojson' : 'https://services1.arcgis.com/ioennV6PpG5Xodq0/ArcGIS/rest/services/OpenData_S1/FeatureServer/17/query?outFields=*&where=1%3D1&f=geojson',
@@ -22,4 +24,52 @@ geo_data = {
     'Individual Locations': {}
 }
 
-crs = "EPSG:2283"
\ No newline at end of file
+crs = "EPSG:2283"
+
+# The heat map of individual locations is sent to the browser as the weighted centers of grid cells that are no larger than
+# what the heat map combines when drawn at zoom level heatmap_zoom (the map is unchanged up to this zoom). The zoom is
+# reduced if needed to keep the number of cells below heatmap_max_cells. Set heatmap_zoom to None to send every point.
+heatmap_zoom = 15
+heatmap_max_cells = 50000
+# Boundaries are simplified and quantized so that they look the same up to zoom level boundary_zoom, and borders shared
+# by 2 areas are only sent once. Set boundary_zoom to None to send the boundaries unchanged
+boundary_zoom = 15
+# Send heat map and marker locations as quantized (~1 m) binary arrays instead of JSON to reduce the size of the map HTML
+compact_points = True
+
+# Maximum number of rendered map layers of each type (data, markers) kept in memory
+layer_cache_entries = 64
+# Maximum number of aggregate cubes (counts of each combination of filter values and geographic unit, see cube.py) kept in
+# memory. Each dataset has 1 cube for the options and 1 for each geographic unit that has been mapped
+cube_cache_entries = 16
+# Maximum total size (bytes) of the rendered map pages kept in memory and shared by all sessions
+render_cache_bytes = 256*2**20
+# Maximum total size (bytes) of the selected rows of filter selections kept in memory and shared by all sessions
+selection_cache_bytes = 64*2**20
+
+# Default for assigning arrests to geographic units using their locations and the boundaries instead of the values in the data
+spatial_join = False
+
+# Maximum number of datasets (table type and year) loaded in parallel
+load_workers = os.cpu_count() or 1
+
+# Loaded data is stored in store_dir so that it does not need to be downloaded again by new server processes.
+# Stored data is used for data_ttl/boundary_ttl seconds before checking for updates.
+# Set the environment variable FCPD_OFFLINE=1 to only use stored files (i.e. pre-seeded files without network access).
+store_dir = os.environ.get('FCPD_STORE_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data_store'))
+data_ttl = 24*60*60
+boundary_ttl = 7*24*60*60
+offline = os.environ.get('FCPD_OFFLINE', '0')=='1'
+# Set the environment variable FCPD_SOURCE_DIR to load data from CSV files of standardized tables in that directory
+# (named <table type>_<year>.csv) instead of OpenPoliceData
+source_dir = os.environ.get('FCPD_SOURCE_DIR')
+
+# Timing of each dashboard rerun (see timing.py) is appended as JSON lines to the file in the environment variable
+# FCPD_TIMING_LOG. Open the dashboard with ?debug in the URL to show the timing of each rerun in the sidebar
+timing_log = os.environ.get('FCPD_TIMING_LOG')
+
+# Geocoded marker addresses are cached in store_dir. Set the environment variable FCPD_GEOCODER_STUB to a CSV file with
+# Address, Latitude, and Longitude columns to look up addresses in that file instead of Nominatim (i.e. for testing)
+geocoder_stub = os.environ.get('FCPD_GEOCODER_STUB')
+# Number of addresses looked up at the same time (requests are still limited to the rate of the geocoder)
+geocode_workers = 4
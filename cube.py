@@ -0,0 +1,91 @@
+import numpy as np
+import pandas as pd
+
+# Aggregate cube of a dataset: the number of rows with each combination of values of its columns (i.e. the filter columns
+# and a geographic unit), built once per dataset. Only combinations that have rows are stored, as the code of each column
+# and the count, sorted by the code of the first column. The counts of a selection are then a sum over the stored
+# combinations (starting with only those of the selected values of the first column) instead of over the rows. Columns
+# that are in the filter index (filters.build_index) use its codes so that selections are given by their selection key
+# (filters.selection_key).
+
+
+def build(index, columns, df=None):
+    # columns: columns of the cube. Columns that are not in the index are taken from df
+    codes = []
+    categories = []
+    for col in columns:
+        if col in index['columns']:
+            codes.append(index['columns'][col]['codes'].astype(np.int64))
+            categories.append(index['columns'][col]['categories'])
+        else:
+            c, cats = pd.factorize(df[col], use_na_sentinel=False)
+            codes.append(c.astype(np.int64))
+            categories.append(cats)
+    sizes = [len(x) for x in categories]
+
+    if np.prod(sizes, dtype=float) < 2**62:
+        # Each combination is 1 integer with the first column as the most significant digit
+        key = np.zeros(index['n'], dtype=np.int64)
+        for c, size in zip(codes, sizes):
+            key = key*size + c
+        cells, counts = np.unique(key, return_counts=True)
+        cell_codes = []
+        for size in reversed(sizes):
+            cells, c = np.divmod(cells, size)
+            cell_codes.append(c)
+        cell_codes = cell_codes[::-1]
+    else:
+        cells, counts = np.unique(np.column_stack(codes), axis=0, return_counts=True)
+        cell_codes = list(cells.T)
+
+    return {
+        'n': index['n'],
+        'order': list(columns),
+        'columns': {col: {'codes': c.astype(np.int32), 'categories': cats}
+                    for col, c, cats in zip(columns, cell_codes, categories)},
+        'counts': counts,
+        # Combinations of value k of the first column are offsets[k]:offsets[k+1]
+        'offsets': np.concatenate([[0], np.cumsum(np.bincount(cell_codes[0], minlength=sizes[0]))]),
+    }
+
+
+def _cells(cube, selection):
+    # Positions of the combinations of a selection (selection key) or None for all combinations
+    selected = {col: codes for col, codes in selection if codes!='ALL'}
+    first = cube['order'][0]
+    if first in selected:
+        codes = np.asarray(selected[first], dtype=np.intp)
+        starts = cube['offsets'][codes]
+        lengths = cube['offsets'][codes+1] - starts
+        cells = np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+    else:
+        cells = None
+
+    for col, codes in selected.items():
+        if col==first:
+            continue
+        col_cube = cube['columns'][col]
+        is_selected = np.zeros(len(col_cube['categories']), dtype=bool)
+        is_selected[list(codes)] = True
+        if cells is None:
+            cells = np.flatnonzero(is_selected[col_cube['codes']])
+        else:
+            cells = cells[is_selected[col_cube['codes'][cells]]]
+    return cells
+
+
+def counts(cube, col, selection=()):
+    # Number of rows of a selection (selection key) with each value of col, in the order of its categories
+    cells = _cells(cube, selection)
+    col_cube = cube['columns'][col]
+    codes = col_cube['codes'] if cells is None else col_cube['codes'][cells]
+    weights = cube['counts'] if cells is None else cube['counts'][cells]
+    return np.bincount(codes, weights=weights, minlength=len(col_cube['categories'])).astype(np.int64)
+
+
+def value_counts(cube, col, selection=()):
+    # Same as df[col].value_counts() of the selected rows (without missing values), in the order of the categories
+    c = counts(cube, col, selection)
+    categories = cube['columns'][col]['categories']
+    keep = (c>0) & np.asarray(pd.notnull(categories))
+    return pd.Series(c[keep], index=categories[keep], name='count')
@@ -0,0 +1,302 @@
+import base64
+import html
+
+import folium
+from folium import plugins
+from folium.template import Template
+from branca.element import Element, MacroElement
+import numpy as np
+
+# Compact encoding of points for the map HTML. Instead of JSON arrays of full precision floats, coordinates are quantized
+# to integers, delta encoded and written as variable length integers (7 bits per byte, like polyline encoding) in a single
+# base64 string, which is decoded in the page by decode_points_js. When the order of the points does not matter, they are
+# sorted along a Z-order curve first so that consecutive points are close and most deltas fit in 1 byte.
+
+decode_points_js = """
+<script>
+function fcpdDecodePoints(enc) {
+    var bin = atob(enc.data);
+    var pos = 0;
+    function next() {
+        var value = 0, scale = 1, b;
+        do {
+            b = bin.charCodeAt(pos++);
+            value += (b & 0x7f) * scale;
+            scale *= 128;
+        } while (b & 0x80);
+        return value;
+    }
+    function nextSigned() {
+        var value = next();
+        return value % 2 ? -(value + 1) / 2 : value / 2;
+    }
+    var points = new Array(enc.n);
+    var lat = 0, lon = 0;
+    for (var i = 0; i < enc.n; i++) {
+        lat += nextSigned();
+        lon += nextSigned();
+        var p = [enc.origin[0] + lat*enc.precision, enc.origin[1] + lon*enc.precision];
+        if (enc.weights) {
+            p.push(next());
+        }
+        points[i] = p;
+    }
+    return points;
+}
+</script>
+"""
+
+
+def _varint(values):
+    # Unsigned integers written as 7 bits per byte with the high bit set on all but the last byte of each value
+    values = values.astype(np.uint64)
+    nbytes = np.ones(len(values), dtype=np.int64)
+    v = values >> np.uint64(7)
+    while (v>0).any():
+        nbytes += v>0
+        v >>= np.uint64(7)
+
+    out = np.empty(nbytes.sum(), dtype=np.uint8)
+    starts = np.cumsum(nbytes) - nbytes
+    for k in range(nbytes.max() if len(values)>0 else 0):
+        has_byte = nbytes>k
+        byte = (values[has_byte] >> np.uint64(7*k)) & np.uint64(0x7f)
+        out[starts[has_byte]+k] = byte.astype(np.uint8) | ((nbytes[has_byte]>k+1).astype(np.uint8) << 7)
+    return out
+
+
+def _unvarint(data):
+    data = np.frombuffer(data, dtype=np.uint8)
+    last = (data & 0x80)==0
+    value_idx = np.concatenate([[0], np.cumsum(last)[:-1]])
+    shift = np.arange(len(data)) - np.concatenate([[0], np.flatnonzero(last)+1])[value_idx]
+    values = np.zeros(last.sum(), dtype=np.uint64)
+    np.add.at(values, value_idx, (data & 0x7f).astype(np.uint64) << (7*shift).astype(np.uint64))
+    return values
+
+
+def _zorder(x, y):
+    def spread(v):
+        v = v.astype(np.uint64) & np.uint64(0xFFFFFFFF)
+        for shift, mask in [(16, 0x0000FFFF0000FFFF), (8, 0x00FF00FF00FF00FF), (4, 0x0F0F0F0F0F0F0F0F),
+                            (2, 0x3333333333333333), (1, 0x5555555555555555)]:
+            v = (v | (v << np.uint64(shift))) & np.uint64(mask)
+        return v
+    return spread(x) | (spread(y) << np.uint64(1))
+
+
+def encode_points(lat, lon, weights=None, precision=1e-5, sort=False):
+    # precision: quantization step in degrees (1e-5 is ~1 m). weights must be non-negative integers (i.e. counts)
+    # sort: whether the points can be reordered to reduce the size
+    lat = np.asarray(lat, dtype=float)
+    lon = np.asarray(lon, dtype=float)
+    origin = [float(lat.min()), float(lon.min())] if len(lat)>0 else [0.0, 0.0]
+    q = np.rint(np.column_stack([lat-origin[0], lon-origin[1]])/precision).astype(np.int64)
+
+    if weights is not None and np.all(weights==1):
+        weights = None
+    elif weights is not None:
+        weights = np.asarray(weights)
+        if weights.min()<0 or not np.all(weights==np.round(weights)):
+            raise ValueError("weights must be non-negative integers")
+
+    if sort:
+        order = np.argsort(_zorder(q[:,1], q[:,0]), kind='stable')
+        q = q[order]
+        weights = weights[order] if weights is not None else None
+
+    delta = np.diff(q, axis=0, prepend=np.zeros((1,2), dtype=np.int64))
+    zigzag = np.where(delta<0, -2*delta-1, 2*delta)
+    values = zigzag if weights is None else np.column_stack([zigzag, weights.astype(np.int64)])
+
+    return {'n': len(lat), 'origin': origin, 'precision': precision, 'weights': weights is not None,
+            'data': base64.b64encode(_varint(values.ravel()).tobytes()).decode('ascii')}
+
+
+def decode_points(enc):
+    # Python version of decode_points_js
+    values = _unvarint(base64.b64decode(enc['data'])).astype(np.int64).reshape(enc['n'], 3 if enc['weights'] else 2)
+    zigzag = values[:,:2]
+    delta = np.where(zigzag % 2==1, -(zigzag+1)//2, zigzag//2)
+    points = np.array(enc['origin']) + np.cumsum(delta, axis=0)*enc['precision']
+    return np.column_stack([points, values[:,2]]) if enc['weights'] else points
+
+
+def _add_decoder(element):
+    element.get_root().header.add_child(Element(decode_points_js), name='fcpd_decode_points')
+
+
+class CompactHeatMap(plugins.HeatMap):
+    # HeatMap with the points (rows of lat, lon, and optionally weight) sent in the compact encoding
+    _template = Template(
+        """
+        {% macro script(this, kwargs) %}
+            var {{ this.get_name() }} = L.heatLayer(
+                fcpdDecodePoints({{ this.encoded|tojson }}),
+                {{ this.options|tojavascript }}
+            );
+        {% endmacro %}
+        """
+    )
+
+    def __init__(self, data, name=None, min_opacity=0.5, max_zoom=18, radius=25, blur=15, gradient=None,
+                 overlay=True, control=True, show=True, **kwargs):
+        plugins.HeatMap.__init__(self, [], name=name, min_opacity=min_opacity, max_zoom=max_zoom, radius=radius,
+                                 blur=blur, gradient=gradient, overlay=overlay, control=control, show=show, **kwargs)
+        data = np.asarray(data, dtype=float).reshape(-1, np.shape(data)[1] if len(data)>0 else 2)
+        if np.isnan(data).any():
+            raise ValueError("data may not contain NaNs.")
+        # The order of heat map points does not matter
+        self.encoded = encode_points(data[:,0], data[:,1], data[:,2] if data.shape[1]>2 else None, sort=True)
+        self._bounds = [[data[:,0].min(), data[:,1].min()], [data[:,0].max(), data[:,1].max()]] if len(data)>0 else \
+            [[None, None], [None, None]]
+
+    def _get_self_bounds(self):
+        return self._bounds
+
+    def render(self, **kwargs):
+        _add_decoder(self)
+        super().render(**kwargs)
+
+
+class CompactMarkers(MacroElement):
+    # Markers added to the parent layer with the locations sent in the compact encoding.
+    # colors: icon color of each marker. names: tooltip and popup of each marker (None for no tooltip/popup)
+    _template = Template(
+        """
+        {% macro script(this, kwargs) %}
+            (function() {
+                var points = fcpdDecodePoints({{ this.encoded|tojson }});
+                var icons = {{ this.icons|tojavascript }}.map(function(x) { return L.AwesomeMarkers.icon(x); });
+                var iconIndex = {{ this.icon_index|tojson }};
+                var names = {{ this.names|tojson }};
+                for (var i = 0; i < points.length; i++) {
+                    var marker = L.marker(points[i], {icon: icons[iconIndex[i]]});
+                    if (names[i] !== null) {
+                        marker.bindTooltip(names[i], {sticky: true}).bindPopup(names[i]);
+                    }
+                    marker.addTo({{ this._parent.get_name() }});
+                }
+            })();
+        {% endmacro %}
+        """
+    )
+
+    def __init__(self, lat, lon, colors, names):
+        super().__init__()
+        self._name = 'CompactMarkers'
+        self.encoded = encode_points(lat, lon)
+        unique_colors, self.icon_index = np.unique(np.asarray(colors, dtype=str), return_inverse=True)
+        self.icons = [folium.Icon(color=c, icon=None).options for c in unique_colors]
+        self.icon_index = self.icon_index.tolist()
+        self.names = [None if x is None else html.escape(str(x)) for x in names]
+
+    def render(self, **kwargs):
+        _add_decoder(self)
+        super().render(**kwargs)
+
+
+class GeoJsonMarkers(MacroElement):
+    # Markers added to the parent layer from 1 GeoJSON FeatureCollection with the color and name of each marker as
+    # properties. Markers of the same color share 1 icon. Arguments are the same as CompactMarkers
+    _template = Template(
+        """
+        {% macro script(this, kwargs) %}
+            (function() {
+                var options = {{ this.icon|tojavascript }};
+                var icons = {};
+                L.geoJson({{ this.data|tojson }}, {
+                    pointToLayer: function(feature, latlng) {
+                        var color = feature.properties.color;
+                        if (!(color in icons)) {
+                            icons[color] = L.AwesomeMarkers.icon(Object.assign({}, options, {markerColor: color}));
+                        }
+                        return L.marker(latlng, {icon: icons[color]});
+                    },
+                    onEachFeature: function(feature, layer) {
+                        if (feature.properties.name !== null) {
+                            layer.bindTooltip(feature.properties.name, {sticky: true}).bindPopup(feature.properties.name);
+                        }
+                    }
+                }).addTo({{ this._parent.get_name() }});
+            })();
+        {% endmacro %}
+        """
+    )
+
+    def __init__(self, lat, lon, colors, names):
+        super().__init__()
+        self._name = 'GeoJsonMarkers'
+        self.icon = folium.Icon(icon=None).options
+        self.icon.pop('marker_color', None)
+        # ~10 cm precision
+        lat = np.round(np.asarray(lat, dtype=float), 6).tolist()
+        lon = np.round(np.asarray(lon, dtype=float), 6).tolist()
+        self.data = {'type': 'FeatureCollection', 'features': [
+            {'type': 'Feature', 'geometry': {'type': 'Point', 'coordinates': [x, y]},
+             'properties': {'color': c, 'name': None if n is None else html.escape(str(n))}}
+            for y, x, c, n in zip(lat, lon, colors, names)
+        ]}
+
+
+# Geometries of a topology (see topology.py)
+decode_topology_js = """
+<script>
+function fcpdTopologyGeometries(topo) {
+    var scale = topo.transform.scale, translate = topo.transform.translate;
+    var arcs = topo.arcs.map(function(arc) {
+        var x = 0, y = 0, points = new Array(arc.length);
+        for (var i = 0; i < arc.length; i++) {
+            x += arc[i][0];
+            y += arc[i][1];
+            points[i] = [x*scale[0] + translate[0], y*scale[1] + translate[1]];
+        }
+        return points;
+    });
+    function ring(ids) {
+        var points = [];
+        ids.forEach(function(id) {
+            var arc = id < 0 ? arcs[~id].slice().reverse() : arcs[id];
+            for (var i = points.length ? 1 : 0; i < arc.length; i++) {
+                points.push(arc[i]);
+            }
+        });
+        return points;
+    }
+    return topo.objects.data.geometries.map(function(g) {
+        if (g.type === 'Polygon') {
+            return {type: 'Polygon', coordinates: g.arcs.map(ring)};
+        } else if (g.type === 'MultiPolygon') {
+            return {type: 'MultiPolygon', coordinates: g.arcs.map(function(p) { return p.map(ring); })};
+        }
+        return null;
+    });
+}
+</script>
+"""
+
+
+class TopologyData(MacroElement):
+    # Geometries of the features of the parent GeoJson, which is created with the same features without geometries (i.e.
+    # so that folium can still style them and add tooltips). GeoJson adds its data with the function <name>_add, which
+    # is declared again here in the same script, so that this declaration is used, to add the geometries first
+    _template = Template(
+        """
+        {% macro script(this, kwargs) %}
+            function {{ this._parent.get_name() }}_add(data) {
+                var geometries = fcpdTopologyGeometries({{ this.topology|tojson }});
+                data.features.forEach(function(feature, i) { feature.geometry = geometries[i]; });
+                {{ this._parent.get_name() }}.addData(data);
+            }
+        {% endmacro %}
+        """
+    )
+
+    def __init__(self, topology):
+        super().__init__()
+        self._name = 'TopologyData'
+        self.topology = topology
+
+    def render(self, **kwargs):
+        self.get_root().header.add_child(Element(decode_topology_js), name='fcpd_decode_topology')
+        super().render(**kwargs)
@@ -1,47 +1,56 @@
 import datetime
 import folium
 from folium import plugins
-from geopy.geocoders import Nominatim
 import json
-import openpolicedata as opd
 import pandas as pd
-import pyproj
 import streamlit as st
-from streamlit_utils import data_editor_on_change
-from streamlit_folium import folium_static
+from streamlit_utils import data_editor_on_change, timing_panel, use_streamlit
+import streamlit.components.v1 as components
+import uuid
 
 import cache
 import config
-from mapping import add_overlays, add_markers
+import filters
+import geocoding
+import layers
+import mapping
+import marker_store
+import timing
 
 # TODO: Add max val in colorbar
 
 st.set_page_config(layout='wide')
-
-group_color = 'Group Color'
-marker_colors = ['red', 'blue', 'green', 'purple', 'orange', 'darkred', 'lightred', 
-                 'beige', 'darkblue', 'darkgreen', 'cadetblue', 'darkpurple', 'white', 
-                 'pink', 'lightblue', 'lightgreen', 'gray', 'black', 'lightgray']
+use_streamlit()
+if 'session_id' not in st.session_state:
+    # Timing of the reruns of a session (see timing.py). Opening the dashboard with ?debug shows it in the sidebar
+    st.session_state['session_id'] = uuid.uuid4().hex[:12]
+    st.session_state['debug'] = 'debug' in st.query_params
+timing.start('rerun', session=st.session_state['session_id'])
+cache.prefetch_boundaries()
+
+group_color = marker_store.group_color
+marker_colors = marker_store.colors
 marker_colors_w_group = [group_color]
 marker_colors_w_group.extend(marker_colors)
 
-default_color = 'blue'
-default_group = 'Default Group'
+default_color = marker_store.default_color
+default_group = marker_store.default_group
 default_statutes = ['ALL']  #['5/1/2001: DRUNK IN PUBLIC OR PROFANE']
 default_ibrs = ['ALL']
 default_map_type = 'Individual Locations'
 default_races = None
+default_table_types = ['ARRESTS']
+default_years = (2022, 2022)
 if 'markers' not in st.session_state:
-    st.session_state['markers'] = pd.DataFrame(columns=['Name','Latitude','Longitude','Group','Color'])
+    st.session_state['markers'], st.session_state['marker_groups'] = marker_store.empty()
     # st.session_state['markers_saved'] = st.session_state['markers'].copy()
-
-    d = {'Name': [default_group], 
-         'Color':[default_color],
-    }
-    st.session_state['marker_groups'] = pd.DataFrame(d)
     # st.session_state['marker_groups_saved'] = st.session_state['marker_groups'].copy()
     st.session_state['unfreeze_disable'] = True
 
+    if 'table_types' in st.query_params.keys():
+        default_table_types = st.query_params.get_all('table_types')
+    if 'years' in st.query_params.keys():
+        default_years = tuple(int(x) for x in st.query_params.get_all('years'))
     if 'map_type' in st.query_params.keys():
         default_map_type = st.query_params['map_type']
     if 'ibrs' in st.query_params.keys():
@@ -60,6 +69,14 @@ if 'markers' not in st.session_state:
     else:
         st.session_state['frozen_filters'] = None
 
+# The filter widgets are given their values through the session state instead of defaults since Streamlit re-creates a
+# widget (at its default) when its default or options change. Their values are set from the URL the first time and from
+# the previous selections when their options change (i.e. when the data years change, which changes the counts in the
+# option labels) so that the selections are kept
+if (selected:=st.session_state.get('selected_filters')):
+    default_table_types, default_years, default_map_type = selected['table_types'], selected['years'], selected['map_type']
+    default_ibrs, default_statutes, default_races = selected['ibrs'], selected['statutes'], selected['races']
+
 county_bounds = cache.get_county_bounds()
 bounds = county_bounds.total_bounds
 lon_center = (bounds[0] + bounds[2]) / 2
@@ -68,63 +85,86 @@ lat_center = (bounds[1] + bounds[3]) / 2
 def strip_count(statutes):
     return [x[:x.rfind(" (")] for x in statutes]
 
-def filter_by_list(df, col, vals):
-    if any([x=='ALL' for x in vals]):
-        return df
-    else:
-        return df[df[col].isin(vals)]
+def set_widget(key, options, value):
+    # Sets the value of the widget key when it is first shown or its options changed
+    options = list(options)
+    if key not in st.session_state or st.session_state.get(key+'_options')!=options:
+        st.session_state[key] = value
+        st.session_state[key+'_options'] = options
+
+def select_labels(options, values):
+    # Options with counts ("value (count)") of values (without counts)
+    return [x for x in options if x[:x.rfind(" (")] in values]
 
 with st.sidebar:
-    table_type = st.selectbox("Data Type", ['ARRESTS'], help='Currently, only arrests 2022 data is available. More data will be available in the future '+
-                              'Please notify if there is an immediate need for more data')
-    
-    year = st.selectbox("Data Year", [2022], help='Currently, only arrests 2022 data is available. More data will be available in the future '+
-                              'Please notify if there is an immediate need for more data')
+    available = cache.get_available_data()
+    set_widget('table_types', available, [x for x in default_table_types if x in available] or list(available)[:1])
+    table_types = st.multiselect("Data Type", list(available), key='table_types',
+                                 help='Select multiple data types to combine them. Records of data types without statutes or IBR codes are only '+
+                                      'included when ALL statutes are selected.')
+    years = sorted({y for t in table_types for y in available[t]})
+    if len(years)==0:
+        st.warning("Select a data type")
+        st.stop()
+
+    # The slider is a range slider only if its value is a range so its value is passed as well. It only changes with
+    # the options so that the slider is not re-created
+    if len(years)>1:
+        set_widget('years_value', years, tuple(default_years) if all(y in years for y in default_years) else (years[-1],)*2)
+    year_range = (years[0], years[0]) if len(years)==1 else \
+        st.select_slider("Data Years", years, value=st.session_state['years_value'], key='years',
+                         help='Select a range of years to combine them')
+    partitions = tuple((t,y) for t in table_types for y in available[t] if year_range[0]<=y<=year_range[1])
     
-    map_type = st.selectbox('Geographic Unit (Most General to Most Specific)',
-                            config.geo_data.keys(),
-                            index=[k for k,x in enumerate(config.geo_data.keys()) if x==default_map_type][0])
+    set_widget('map_type', config.geo_data, default_map_type if default_map_type in config.geo_data else 
+               list(config.geo_data)[0])
+    map_type = st.selectbox('Geographic Unit (Most General to Most Specific)', config.geo_data.keys(), key='map_type')
     
-    df, unique_races = cache.get_data(table_type, year)
-
-    ibr_options = cache.get_ibr_options(df)
-    default = []
-    for x in default_ibrs:
-        matches = [y for y in ibr_options if y.startswith(x+' (')]
-        default.extend(matches)
-        
-    ibrs = st.multiselect("IBR Code", ibr_options, default=default, 
+    spatial_join = st.checkbox("Assign to Geographic Units by Location", value=config.spatial_join,
+                               help="The data includes the geographic units (district, station, etc.) of each record, which may not always "+
+                                    "agree with the boundaries drawn on the map. Check this box to assign records to geographic units "+
+                                    "using their locations instead. Records without a valid location will not be counted.")
+
+    df, unique_races, filter_index = cache.get_data(partitions, spatial_join)
+    dataset = cache.dataset_key(partitions, spatial_join, df)
+    if (coords:=df.attrs['coordinates'])['kept']<coords['total']:
+        st.caption(f"{coords['total']-coords['kept']} of {coords['total']} records do not have a valid location "+
+                   f"({coords['null']} missing, {coords['invalid']} invalid) and are not shown on the heat map")
+
+    ibr_options = cache.get_ibr_options(dataset, filter_index)
+    set_widget('ibrs', ibr_options, select_labels(ibr_options, default_ibrs))
+    ibrs = st.multiselect("IBR Code", ibr_options, key='ibrs',
                    help='Type in this box to search for IBR codes. Filtering by IBR code filters the available statutes. '+
                         "Actual filtering of the data is based on the value in the Statutes box. To show all results for an "+
                         "IBR code, select All under statutes.")
     
     ibrs_list = strip_count(ibrs)
-    df_rem = filter_by_list(df.copy(), 'IBR Full', ibrs_list)
-
-    statute_options = cache.get_statute_options(df_rem)
-    default = []
-    for x in default_statutes:
-        matches = [y for y in statute_options if y.startswith(x+' (')]
-        default.extend(matches)
-        
-    statutes = st.multiselect("Statutes", statute_options, default=default, 
+    statute_options = cache.get_statute_options(dataset, filters.selection_key(filter_index, {'IBR Full': ibrs_list}), 
+                                                filter_index)
+    set_widget('statutes', statute_options, select_labels(statute_options, default_statutes))
+    statutes = st.multiselect("Statutes", statute_options, key='statutes',
                    help='Type in this box to search for statutes')
     
     statutes_list = strip_count(statutes)
-    df_rem = filter_by_list(df_rem, 'Statute Full', statutes_list)
 
-    races = st.multiselect("Race/Ethnicity", unique_races,
-                           default=default_races if default_races else unique_races,
-                           key='race_multi_select',
+    set_widget('race_multi_select', unique_races, 
+               list(unique_races) if default_races is None else [x for x in unique_races if x in default_races])
+    races = st.multiselect("Race/Ethnicity", unique_races, key='race_multi_select',
                            help='More demographics filters (gender, age) can be added')
     
-    df_rem = df_rem[df_rem[opd.defs.columns.RE_GROUP_SUBJECT].isin(races)]
+    selections = {'IBR Full': ibrs_list, 'Statute Full': statutes_list, cache.columns().RE_GROUP_SUBJECT: races}
+    selection = filters.selection_key(filter_index, selections)
+    # Selected rows are shared by all sessions with the same selection
+    rows = cache.get_selection(dataset, selection, filter_index, selections)
 
-    st.text(f"Total Selected: {len(df_rem)}")
+    st.text(f"Total Selected: {len(df) if rows is None else len(rows)}")
+    st.session_state['selected_filters'] = {'table_types': table_types, 'years': year_range, 'map_type': map_type, 
+                                            'ibrs': ibrs_list, 'statutes': statutes_list, 'races': races}
 
 st.info("Hover over question marks and buttons for helpful hints on using this dashboard. Add markers and adjust settings below map.")
 
-st.header(f"Heat Map of Arrests" if map_type=='Individual Locations' else f"Number of Arrests in Each {map_type}")
+label = mapping.record_label(partitions)
+st.header(f"Heat Map of {label}" if map_type=='Individual Locations' else f"Number of {label} in Each {map_type}")
 col1, col2, col3, col4 = st.columns(4)
 with col1:
     def freeze_click():
@@ -133,7 +173,11 @@ with col1:
                                               'ibrs': ibrs,
                                               'statutes': statutes, 
                                               'races': races,
-                                              'df_rem': df_rem.copy()}
+                                              'dataset': dataset,
+                                              'selection': selection,
+                                              'df': df,
+                                              'index': filter_index,
+                                              'rows': rows}
     st.button('Freeze', on_click=freeze_click, help="Click this button to keep the current map and compare to a 2nd map.")
 
 plot_dual = st.session_state['frozen_filters']!=None
@@ -155,6 +199,8 @@ with col4:
                     "\n\nNote: Markers are not saved. Click Export Markers button below to save markers."):
         
         st.query_params.clear()
+        st.query_params['table_types'] = table_types
+        st.query_params['years'] = [str(x) for x in year_range]
         st.query_params['map_type'] = map_type
         st.query_params['ibrs'] = ibrs_list
         st.query_params['statutes'] = statutes_list
@@ -166,22 +212,13 @@ with col4:
             st.query_params['frozen_statutes'] = strip_count(st.session_state['frozen_filters']['statutes'])
             st.query_params['frozen_races'] = st.session_state['frozen_filters']['races']
 
-
-map = plugins.DualMap if plot_dual else folium.Map
-
-zoom_start = 10 if plot_dual else 10
-map_container = map(location=[lat_center, lon_center], zoom_start=zoom_start, min_zoom=zoom_start)
-
-m = map_container.m2 if plot_dual else map_container
-
 container = st.container(border=False)
 
 opacity = st.slider('Opacity', 0.0, 1.0, 0.6, step=0.05) if map_type!='Individual Locations' else None
-add_overlays(map_type, county_bounds, df_rem, m, config.geo_data, opacity, legend=not plot_dual)
 if plot_dual:
     opacity = st.slider('Opacity', 0.0, 1.0, 0.6, step=0.05) \
         if st.session_state['frozen_filters']['map_type']!='Individual Locations' and not opacity else opacity
-    if 'df_rem' not in st.session_state['frozen_filters']:
+    if 'rows' not in st.session_state['frozen_filters']:
         # frozen_filters was populated from command line
         frozen_ibrs = st.session_state['frozen_filters']['ibrs']
         st.session_state['frozen_filters']['ibrs'] = []
@@ -195,14 +232,18 @@ if plot_dual:
             v = [x for x in statute_options if x.startswith(v+' (')][0]
             st.session_state['frozen_filters']['statutes'].append(v)
             
-        st.session_state['frozen_filters']['df_rem'] = filter_by_list(df.copy(), 'IBR Full', frozen_ibrs)
-        st.session_state['frozen_filters']['df_rem'] = filter_by_list(st.session_state['frozen_filters']['df_rem'], 'Statute Full', frozen_statutes)
-        st.session_state['frozen_filters']['df_rem'] = st.session_state['frozen_filters']['df_rem'][
-            st.session_state['frozen_filters']['df_rem'][opd.defs.columns.RE_GROUP_SUBJECT].isin(st.session_state['frozen_filters']['races'])
-        ]
-
-    add_overlays(st.session_state['frozen_filters']['map_type'], county_bounds, 
-                 st.session_state['frozen_filters']['df_rem'], map_container.m1, config.geo_data, opacity, legend=False)
+        frozen_selections = {
+            'IBR Full': frozen_ibrs, 
+            'Statute Full': frozen_statutes, 
+            cache.columns().RE_GROUP_SUBJECT: st.session_state['frozen_filters']['races']
+        }
+        frozen_selection = filters.selection_key(filter_index, frozen_selections)
+        st.session_state['frozen_filters']['df'] = df
+        st.session_state['frozen_filters']['index'] = filter_index
+        st.session_state['frozen_filters']['rows'] = cache.get_selection(dataset, frozen_selection, filter_index, 
+                                                                         frozen_selections)
+        st.session_state['frozen_filters']['dataset'] = dataset
+        st.session_state['frozen_filters']['selection'] = frozen_selection
 
 marker_config = {
     'Latitude' : st.column_config.NumberColumn(format="%.5f"),
@@ -217,33 +258,31 @@ group_config = {
 
 with st.expander("Add Markers to Map", expanded=True):
     default_address = 'Type address to find Lat/Long for new marker and click Enter'
+    def add_markers(imports):
+        # Adds the markers and groups of each import (list of (markers, marker_groups)). Returns the number of invalid markers
+        st.session_state['markers'], st.session_state['marker_groups'], dropped = \
+            marker_store.merge(st.session_state['markers'], st.session_state['marker_groups'], imports)
+        return dropped
+
+    def add_geocoded_markers(addresses, locations):
+        # Adds markers for the addresses that were found near the map. Returns the addresses that were not found and 
+        # the addresses that are too far away (see geocoding.to_markers)
+        markers, not_found, far = geocoding.to_markers(addresses, locations, (lat_center, lon_center))
+        if len(markers)>0:
+            add_markers([(markers, pd.DataFrame(columns=marker_store.group_columns))])
+        return not_found, far
+
     def address_on_change():
         st.session_state['address_entered'] = True
         if len(st.session_state.address.strip())>0 and st.session_state.address!=default_address:
-            geolocator = Nominatim(user_agent="FCPD Mapping Dashboard")
-            try:
-                location = geolocator.geocode(st.session_state.address)
-                # Check that found location is suitably close
-                transformer = pyproj.Transformer.from_crs("EPSG:4326", config.crs)
-                x0,y0 = transformer.transform(lat_center, lon_center)
-                x1,y1 = transformer.transform(location.latitude, location.longitude)
-                units = pyproj.CRS.from_epsg(2283).coordinate_system.axis_list[0].unit_name
-
-                if units!='US survey foot':
-                    raise ValueError("Currently, only units of feet can be tested. Notify dashboard ")
-                
-                dist = ((x1-x0)**2 + (y1-y0)**2)**0.5 / 5280
-                if dist>100:
-                    # This is really far away and unlikely to have been user's desired marker location
-                    st.toast(f"Latitude/Longitude found is {round(dist)} miles from center of map and is unlikely to be desired location. "+
-                             "Marker not added.")
-                    
-                st.session_state['markers'] = pd.concat([st.session_state['markers'], 
-                                pd.DataFrame([('',location.latitude, location.longitude,default_group,group_color)], 
-                                             columns=st.session_state['markers'].columns)],
-                                ignore_index=True)
-            except:
-                st.toast(f"Latitude/Longitude not found for {st.session_state.address}")
+            address = st.session_state.address
+            not_found, far = add_geocoded_markers(pd.DataFrame({'Address': [address]}), 
+                                                  [geocoding.get_geocoder().geocode(address)])
+            if not_found:
+                st.toast(f"Latitude/Longitude not found for {address}")
+            elif far:
+                st.toast(f"Latitude/Longitude found is {round(far[0][1])} miles from center of map and is unlikely to be desired location. "+
+                         "Marker not added.")
 
     st.text_input(label='Address for New Marker',
                   key='address',
@@ -261,30 +300,44 @@ with st.expander("Add Markers to Map", expanded=True):
                                           help='Import markers from .json files. Click Add Markers button after uploading files to add.')
 
         if st.form_submit_button("Add Markers"):
+            # Files are validated first and then all of the markers are added at once
+            imports = []
             for uploaded_file in uploaded_files:
-                loaded = False
                 try:
-                    data = json.load(uploaded_file)
-                    loaded = True
-                except:
-                    st.toast(f"Unable to load {uploaded_file.name}")
-                
-                if loaded:
-                    # Validate file
-                    if val:=(len(data.keys())==2 and 'markers' in data.keys() and 'marker_groups' in data.keys()):
-                        # Validate
-                        for k,v in data.items():
-                            val &= all([[x in st.session_state[k].columns for x in v.keys()]])
-                    if val:
-                        for k,v in data.items():
-                            try:
-                                st.session_state[k] = pd.concat([st.session_state[k], pd.DataFrame(v)], ignore_index=True).drop_duplicates()
-                            except:
-                                st.toast(f"Unable to load {k} from {uploaded_file.name}")
-                    else:
-                        st.toast(f"{uploaded_file.name} does not contain markers and marker groups in the expected format")
+                    imports.append(marker_store.read_export(json.load(uploaded_file)))
+                except ValueError as e:
+                    # JSON errors are also ValueErrors
+                    st.toast(f"{uploaded_file.name} does not contain markers and marker groups in the expected format: {e}")
+            if (dropped:=add_markers(imports)):
+                st.toast(f"{dropped} imported markers without a valid Latitude/Longitude were not added")
 
 
+    with st.form("address-form", clear_on_submit=True):
+        address_file = st.file_uploader("Choose .csv file of addresses to add as markers", 
+                                        type=['csv'],
+                                        help='CSV file with an Address column and optional Name and Group columns. '+
+                                            'Addresses are looked up and added as markers. Click Add Addresses button after uploading file to add.')
+
+        if st.form_submit_button("Add Addresses") and address_file:
+            try:
+                addresses = geocoding.read_addresses(address_file)
+            except ValueError as e:
+                addresses = None
+                st.toast(f"{address_file.name} is not a CSV file of addresses: {e}")
+            if addresses is not None:
+                progress = st.progress(0.0, text=f"Finding {len(addresses)} addresses")
+                locations = geocoding.get_geocoder().geocode_many(addresses['Address'].tolist(), 
+                                                                  progress=lambda x: progress.progress(x))
+                progress.empty()
+                not_found, far = add_geocoded_markers(addresses, locations)
+                st.toast(f"Added {len(addresses)-len(not_found)-len(far)} of {len(addresses)} addresses")
+                if not_found:
+                    st.toast(f"Latitude/Longitude not found for {len(not_found)} addresses: {', '.join(not_found[:5])}"+
+                             ("..." if len(not_found)>5 else ""))
+                if far:
+                    st.toast(f"{len(far)} addresses are more than 100 miles from the center of the map and were not added: "+
+                             ', '.join(x for x,_ in far[:5]) + ("..." if len(far)>5 else ""))
+
     with marker_container:
         st.subheader("Markers",
                     help="List of markers. To delete a marker, click on the empty column on the left and then click the track can icon "+
@@ -321,14 +374,37 @@ with st.expander("Add Markers to Map", expanded=True):
         help="Download markers and marker groups so that they can be reused (imported) into a future session."
     )
 
-if plot_dual:
-    add_markers(map_container.m1)
-    add_markers(map_container.m2)
-    folium.LayerControl().add_to(map_container.m1)
-    folium.LayerControl().add_to(map_container.m2)
-else:
-    add_markers(map_container)
-    folium.LayerControl().add_to(map_container)
+zoom_start = 10 if plot_dual else 10
+
+def add_data_layers(m, map_type, dataset, selection, df, rows, index, opacity, legend):
+    layers.add_to(m, mapping.get_data_layers(map_type, dataset, selection, opacity, legend, df, rows, index))
+    if map_type=='Individual Locations':
+        layers.add_to(m, mapping.get_county_layers())
+
+def build_map():
+    map = plugins.DualMap if plot_dual else folium.Map
+    map_container = map(location=[lat_center, lon_center], zoom_start=zoom_start, min_zoom=zoom_start)
+
+    m = map_container.m2 if plot_dual else map_container
+    add_data_layers(m, map_type, dataset, selection, df, rows, filter_index, opacity, legend=not plot_dual)
+    if plot_dual:
+        frozen = st.session_state['frozen_filters']
+        add_data_layers(map_container.m1, frozen['map_type'], frozen['dataset'], frozen['selection'], frozen['df'], 
+                        frozen['rows'], frozen['index'], opacity, legend=False)
+
+    marker_layers = mapping.get_marker_layers(st.session_state['markers'], st.session_state['marker_groups'])
+    for x in ([map_container.m1, map_container.m2] if plot_dual else [map_container]):
+        layers.add_to(x, marker_layers)
+        folium.LayerControl().add_to(x)
+    return map_container
+
+# The rendered page is identified by everything that it is built from. The data layers are identified by their
+# selection keys instead of their rows. The same page is used for both the displayed and the downloaded map
+frozen = st.session_state['frozen_filters']
+map_key = cache.fingerprint(plot_dual, lat_center, lon_center, zoom_start, map_type, dataset, selection, opacity,
+                            (frozen['map_type'], frozen['dataset'], frozen['selection']) if plot_dual else None,
+                            st.session_state['markers'], st.session_state['marker_groups'])
+map_html = cache.map_to_html(map_key, build_map)
 
 with container:
     if plot_dual:
@@ -341,11 +417,12 @@ with container:
         with col2:
             st.info("Left map is filtered for the current filter selections")
     width = 1000 if plot_dual else 700
-    folium_static(map_container, width=width)
+    with timing.span('components.html', bytes=len(map_html)):
+        components.html(map_html, width=width, height=510)
 
 download_container.download_button(
     label='Download Map',
-    data = cache.map_to_html(str(plot_dual), map_type, ibrs, statutes, races, map_container),
+    data = map_html,
     file_name="map_"+datetime.datetime.now().strftime('%Y%m%d_%H%M%S'+".html"),
     help="Download current map as HTML file"
 )
@@ -355,4 +432,8 @@ st.markdown("The dashboard is generated using data from the "+
             "[Fairfax County Police Open Data Portal](https://www.fcpod.org/pages/crime-data). "+
             "[OpenPoliceData](https://openpolicedata.readthedocs.io/) was used to load data into this dashboard " +
             "and is freely available for others to easily download the raw data.\n\n"+
-            'Report issues, feature requests, or suggestions to openpolicedata@gmail.com or our [GitHub issues page](https://github.com/sowdm/fcpd_mapping/issues).')
\ No newline at end of file
+            'Report issues, feature requests, or suggestions to openpolicedata@gmail.com or our [GitHub issues page](https://github.com/sowdm/fcpd_mapping/issues).')
+
+if st.session_state['debug']:
+    timing_panel(timing.current(), cache.cache_stats())
+timing.finish()
\ No newline at end of file
@@ -0,0 +1,117 @@
+import numpy as np
+import pandas as pd
+
+# Index of the filter columns that is built once per dataset. For each column, it stores the integer code of
+# every row and the sorted row positions of every value so that a combination of selections resolves to row
+# positions without scanning or copying the table.
+
+def _key(value):
+    # NaN is a valid selection (i.e. missing race) but NaN!=NaN so it needs a consistent key
+    return None if pd.isnull(value) else value
+
+
+def build_index(df, columns):
+    index = {'n': len(df), 'columns': {}}
+    for col in columns:
+        codes, categories = pd.factorize(df[col], sort=True, use_na_sentinel=False)
+        codes = codes.astype(np.int32)
+        order = np.argsort(codes, kind='stable')
+        counts = np.bincount(codes, minlength=len(categories))
+        index['columns'][col] = {
+            'codes': codes,
+            'categories': categories,
+            'lookup': {_key(v): k for k,v in enumerate(categories)},
+            'counts': counts,
+            'positions': np.split(order, np.cumsum(counts)[:-1]),
+        }
+    return index
+
+
+def append_index(index, df, start):
+    # Index of df from the index of its first start rows. Only the rows after start are indexed. Values that
+    # are not in the index are added after the existing values
+    new_index = {'n': len(df), 'columns': {}}
+    for col, col_index in index['columns'].items():
+        codes, uniques = pd.factorize(df[col].iloc[start:], use_na_sentinel=False)
+        lookup = dict(col_index['lookup'])
+        added = []
+        mapping = np.empty(len(uniques), dtype=np.int32)
+        for k, v in enumerate(uniques):
+            if (key:=_key(v)) not in lookup:
+                lookup[key] = len(col_index['categories']) + len(added)
+                added.append(v)
+            mapping[k] = lookup[key]
+        codes = mapping[codes]
+
+        categories = col_index['categories'].append(pd.Index(added)) if added else col_index['categories']
+        counts = np.bincount(codes, minlength=len(categories))
+        new_positions = np.split(start + np.argsort(codes, kind='stable'), np.cumsum(counts)[:-1])
+        positions = col_index['positions'] + [np.array([], dtype=np.intp)]*len(added)
+        for k in np.flatnonzero(counts):
+            positions[k] = np.concatenate([positions[k], new_positions[k]])
+        new_index['columns'][col] = {
+            'codes': np.concatenate([col_index['codes'], codes]),
+            'categories': categories,
+            'lookup': lookup,
+            'counts': np.append(col_index['counts'], np.zeros(len(added), dtype=col_index['counts'].dtype)) + counts,
+            'positions': positions,
+        }
+    return new_index
+
+
+def _selected_codes(col_index, vals):
+    # Sorted codes of the selected values or None if all values are selected
+    if any([x=='ALL' for x in vals]):
+        return None
+    codes = np.array(sorted({col_index['lookup'][k] for x in vals if (k:=_key(x)) in col_index['lookup']}), dtype=np.int32)
+    return None if len(codes)==len(col_index['categories']) else codes
+
+
+def missing_values(index, col, vals):
+    # Selected values of col that are not in the data (and are ignored by select)
+    return [x for x in vals if x!='ALL' and _key(x) not in index['columns'][col]['lookup']]
+
+
+def select(index, selections):
+    # selections: dictionary of column: list of selected values. A list containing 'ALL' does not filter.
+    # Returns sorted row positions or None if all rows are selected
+    active = []
+    for col, vals in selections.items():
+        col_index = index['columns'][col]
+        if (codes:=_selected_codes(col_index, vals)) is not None:
+            active.append((col_index['counts'][codes].sum(), col_index, codes))
+
+    if len(active)==0:
+        return None
+
+    # Start from the most selective column and then only check the remaining columns for those rows
+    active.sort(key=lambda x: x[0])
+    _, col_index, codes = active[0]
+    rows = np.sort(np.concatenate([col_index['positions'][k] for k in codes] or [np.array([], dtype=np.intp)]))
+    for _, col_index, codes in active[1:]:
+        is_selected = np.zeros(len(col_index['categories']), dtype=bool)
+        is_selected[codes] = True
+        rows = rows[is_selected[col_index['codes'][rows]]]
+
+    return rows
+
+
+def counts(index, col, rows=None):
+    # Number of rows with each value of col (in the order of the column's categories) among rows (all rows if None)
+    col_index = index['columns'][col]
+    if rows is None:
+        return col_index['counts']
+    return np.bincount(col_index['codes'][rows], minlength=len(col_index['categories']))
+
+
+def take(df, rows):
+    return df if rows is None else df.iloc[rows]
+
+
+def selection_key(index, selections):
+    # Hashable key of a selection that is the same for equivalent selections (i.e. different order or all values selected)
+    key = []
+    for col, vals in sorted(selections.items()):
+        codes = _selected_codes(index['columns'][col], vals)
+        key.append((col, 'ALL' if codes is None else tuple(codes.tolist())))
+    return tuple(key)
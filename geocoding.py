@@ -0,0 +1,199 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import closing, contextmanager
+import functools
+import os
+import re
+import sqlite3
+import threading
+import time
+
+import pandas as pd
+
+import caching
+import config
+import marker_store
+
+# Geocoding of marker addresses. Results (including addresses that were not found) are cached in a SQLite database in
+# store_dir that is shared by all sessions and server processes so that each address is only looked up once. Requests
+# to the backend are limited to its rate (i.e. Nominatim allows 1 request per second) and lists of addresses are looked
+# up concurrently within that rate. Backends have a name (which is part of the cache key), a rate (requests per second
+# or None), and geocode(address), which returns (latitude, longitude) or None if the address is not found.
+
+
+class NominatimBackend:
+    name = 'nominatim'
+    rate = 1
+
+    def __init__(self, user_agent="FCPD Mapping Dashboard"):
+        from geopy.geocoders import Nominatim
+        self._geolocator = Nominatim(user_agent=user_agent, timeout=10)
+
+    def geocode(self, address):
+        location = self._geolocator.geocode(address)
+        return None if location is None else (location.latitude, location.longitude)
+
+
+class StubBackend:
+    # Local lookup table of addresses (i.e. for testing or without network access)
+    name = 'stub'
+    rate = None
+
+    def __init__(self, locations):
+        # locations: dictionary of address: (latitude, longitude)
+        self.locations = {normalize(k):v for k,v in locations.items()}
+
+    @classmethod
+    def from_csv(cls, path):
+        # CSV file with Address, Latitude, and Longitude columns
+        df = pd.read_csv(path)
+        return cls(dict(zip(df['Address'], zip(df['Latitude'], df['Longitude']))))
+
+    def geocode(self, address):
+        return self.locations.get(normalize(address))
+
+
+def normalize(address):
+    # Cache key of an address. Case and whitespace do not change the result
+    return re.sub(r'\s+', ' ', str(address)).strip().casefold()
+
+
+class _RateLimiter:
+    def __init__(self, rate):
+        self.interval = 1/rate if rate else 0
+        self._next = 0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        # Waits for the next request slot. Slots are reserved in the order that threads arrive
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next)
+            self._next = slot + self.interval
+        time.sleep(slot - now)
+
+
+class AddressCache:
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with self._connect() as db:
+            db.execute('CREATE TABLE IF NOT EXISTS geocode (backend TEXT, address TEXT, latitude REAL, longitude REAL, '+
+                       'saved REAL, PRIMARY KEY (backend, address))')
+
+    @contextmanager
+    def _connect(self):
+        # Connections are not shared between threads. Changes are committed if the block succeeds
+        with closing(sqlite3.connect(self.path, timeout=30)) as db, db:
+            yield db
+
+    def get_many(self, backend, keys):
+        # Dictionary of key: (latitude, longitude) or None (not found) of the keys that are cached
+        keys = list(keys)
+        found = {}
+        with self._connect() as db:
+            # SQLite limits the number of parameters of a query
+            for i in range(0, len(keys), 500):
+                chunk = keys[i:i+500]
+                rows = db.execute(f"SELECT address, latitude, longitude FROM geocode WHERE backend=? AND address IN "+
+                                  f"({','.join('?'*len(chunk))})", [backend, *chunk]).fetchall()
+                found.update({k:None if lat is None else (lat, lon) for k, lat, lon in rows})
+        return found
+
+    def put_many(self, backend, results):
+        # results: dictionary of key: (latitude, longitude) or None
+        now = time.time()
+        with self._connect() as db:
+            db.executemany('INSERT OR REPLACE INTO geocode VALUES (?, ?, ?, ?, ?)',
+                           [(backend, k, *(v if v else (None, None)), now) for k,v in results.items()])
+
+
+class Geocoder:
+    def __init__(self, backend, cache_path, workers=4):
+        self.backend = backend
+        self.cache = AddressCache(cache_path)
+        self.workers = workers
+        self._limiter = _RateLimiter(backend.rate)
+
+    def _lookup(self, address):
+        self._limiter.wait()
+        return self.backend.geocode(address)
+
+    def geocode(self, address):
+        return self.geocode_many([address])[0]
+
+    def geocode_many(self, addresses, progress=None):
+        # Returns (latitude, longitude) or None (not found) for each address. Addresses that are not cached are looked
+        # up concurrently. Failed lookups (i.e. network errors) are returned as None but not cached.
+        # progress: optional function that is passed the fraction of lookups done
+        keys = [normalize(x) for x in addresses]
+        found = self.cache.get_many(self.backend.name, set(keys))
+        missing = {k:x for k,x in zip(keys, addresses) if k not in found}
+
+        results = {}
+        if missing:
+            with ThreadPoolExecutor(max_workers=max(1, min(self.workers, len(missing)))) as pool:
+                futures = {pool.submit(self._lookup, x):k for k,x in missing.items()}
+                for i, future in enumerate(as_completed(futures)):
+                    try:
+                        results[futures[future]] = future.result()
+                    except Exception:
+                        found[futures[future]] = None
+                    if progress:
+                        progress((i+1)/len(futures))
+            self.cache.put_many(self.backend.name, results)
+        found.update(results)
+        return [found[k] for k in keys]
+
+
+@caching.cache_resource(show_spinner=False)
+def get_geocoder():
+    # Geocoder shared by all sessions. Set FCPD_GEOCODER_STUB to use a StubBackend (see config)
+    backend = StubBackend.from_csv(config.geocoder_stub) if config.geocoder_stub else NominatimBackend()
+    return Geocoder(backend, os.path.join(config.store_dir, 'geocode.sqlite'), config.geocode_workers)
+
+
+def read_addresses(file):
+    # Table of a CSV file of addresses with an Address column and optional Name and Group columns. Rows without an
+    # address are dropped. Raises ValueError if the file is not in that format
+    try:
+        addresses = pd.read_csv(file, dtype=str).fillna('')
+    except Exception as e:
+        raise ValueError(f"Unable to read CSV file: {e}")
+    if 'Address' not in addresses.columns:
+        raise ValueError("File does not have an Address column")
+    return addresses[addresses['Address'].str.strip()!=''].reset_index(drop=True)
+
+
+def to_markers(addresses, locations, center, max_miles=100):
+    # Markers (see marker_store) of the addresses (table from read_addresses) at their locations (from geocode_many) that
+    # are within max_miles of center (latitude, longitude). Returns the markers, the addresses that were not found, and
+    # (address, distance) of the addresses that are too far away, which are unlikely to be the desired locations
+    not_found = []
+    far = []
+    rows = []
+    for k, location in enumerate(locations):
+        address = addresses['Address'].iloc[k]
+        if location is None:
+            not_found.append(address)
+        elif (dist:=distance_miles(*center, *location))>max_miles:
+            far.append((address, dist))
+        else:
+            rows.append((addresses['Name'].iloc[k] if 'Name' in addresses else '', *location,
+                         addresses['Group'].iloc[k] if 'Group' in addresses else marker_store.default_group,
+                         marker_store.group_color))
+    return pd.DataFrame(rows, columns=marker_store.marker_columns), not_found, far
+
+
+@functools.lru_cache
+def _to_crs():
+    import pyproj
+    units = pyproj.CRS.from_user_input(config.crs).coordinate_system.axis_list[0].unit_name
+    if units!='US survey foot':
+        raise ValueError(f"Distances can only be computed in feet. Units of {config.crs} are {units}")
+    return pyproj.Transformer.from_crs("EPSG:4326", config.crs)
+
+
+def distance_miles(lat0, lon0, lat1, lon1):
+    x0, y0 = _to_crs().transform(lat0, lon0)
+    x1, y1 = _to_crs().transform(lat1, lon1)
+    return ((x1-x0)**2 + (y1-y0)**2)**0.5 / 5280
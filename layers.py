@@ -0,0 +1,93 @@
+import re
+import uuid
+
+from branca.element import Element
+import folium
+from folium.map import Layer
+
+# Layers of the map (i.e. data plot, county boundary, markers) are rendered to HTML/JS once and cached. Each rerun then
+# builds a new (cheap) base map and adds the cached fragments instead of rebuilding and serializing every layer.
+
+_map_id = 'fcpd_fragment_map'
+
+
+class _Raw(Element):
+    # Already rendered text. Element(text) would compile the text as a template
+    def __init__(self, text):
+        super().__init__()
+        self.text = text
+
+    def render(self, **kwargs):
+        return self.text
+
+
+def render_layers(build):
+    # build: function that adds layers to the map passed to it
+    # Returns a list with the rendered fragment of each layer added to the map
+    m = folium.Map(tiles=None)
+    m._id = _map_id
+    build(m)
+    figure = m.get_root()
+
+    fragments = []
+    for layer in m._children.values():
+        if not isinstance(layer, Layer):
+            raise TypeError(f"Only layers can be cached. {layer} is not a layer")
+        # Each layer starts with an empty page so that its fragment includes all of the dependencies that it adds
+        sections = (figure.header, figure.html, figure.script)
+        for x in sections:
+            x._children.clear()
+        layer.render()
+        header, html, script = [[(k, v.render()) for k,v in x._children.items()] for x in sections]
+
+        ids = set()
+        def add_ids(element):
+            ids.add(element._id)
+            for child in element._children.values():
+                add_ids(child)
+        add_ids(layer)
+
+        fragments.append({
+            'name': layer.layer_name,
+            'overlay': layer.overlay,
+            'control': layer.control,
+            'show': layer.show,
+            'var': layer.get_name(),
+            'ids': sorted(ids),
+            'header': header,
+            'html': html,
+            'script': '\n'.join(x[1] for x in script),
+        })
+
+    return fragments
+
+
+class CachedLayer(Layer):
+    # A layer added to a map from its rendered fragment. Element IDs in the fragment are made unique for each
+    # CachedLayer so that a fragment can be added to a page more than once (i.e. both maps of a DualMap)
+    def __init__(self, fragment):
+        super().__init__(name=fragment['name'], overlay=fragment['overlay'], control=fragment['control'],
+                         show=fragment['show'])
+        self._name = 'cached_layer'
+        self.fragment = fragment
+        self._suffix = uuid.uuid4().hex[:8]
+
+    def _rename(self, text):
+        names = {i: i+self._suffix for i in self.fragment['ids']}
+        names['map_'+_map_id] = self._parent.get_name()
+        return re.sub('|'.join(re.escape(x) for x in names), lambda x: names[x.group(0)], text)
+
+    def get_name(self):
+        return self._rename(self.fragment['var']) if self._parent else super().get_name()
+
+    def render(self, **kwargs):
+        figure = self.get_root()
+        for section, items in zip((figure.header, figure.html), (self.fragment['header'], self.fragment['html'])):
+            for name, text in items:
+                section.add_child(_Raw(self._rename(text)), name=self._rename(name))
+        figure.script.add_child(_Raw(self._rename(self.fragment['script'])), name=self.get_name())
+
+
+def add_to(m, fragments):
+    for fragment in fragments:
+        CachedLayer(fragment).add_to(m)
@@ -2,19 +2,32 @@ import folium
 from folium import plugins
 import geopandas as gpd
 import numpy as np
-import pandas as pd
-import streamlit as st
 
 import cache
+import caching
+import config
+from encoding import CompactHeatMap, CompactMarkers, GeoJsonMarkers, TopologyData
+import filters
+import layers
+import marker_store
+import timing
+import topology
+
+def region_counts(df, df_on, keys, value_counts=None):
+    # Number of rows of df in each region. keys: region IDs (strings). Regions without rows are NaN
+    # value_counts: number of rows with each value of df_on (i.e. from cache.value_counts) to use instead of counting df
+    # Count the raw values before converting to strings so that only the counts are converted
+    vc = df[df_on].value_counts() if value_counts is None else value_counts.copy()
+    vc.index = vc.index.astype(str)
+    return vc.groupby(level=0).sum().reindex(keys).astype(float)
+
 
 def Choropleth(m, geojson_link, df, bounds_on, df_on, data_label, tooltip_labels, 
-               test=None, skip_test=True, max_val=None, exclude=[], opacity=0.6, legend=True):
-    bounds = cache.load_geojson(geojson_link)
-    
-    if len(exclude)>0:
-        bounds = bounds[~bounds[bounds_on].isin(exclude)]
+               test=None, skip_test=True, max_val=None, exclude=[], opacity=0.6, legend=True, value_counts=None):
+    geo, topo, keys = cache.get_boundary_geojson(geojson_link, bounds_on, tuple(exclude), config.boundary_zoom)
 
     if not skip_test:
+        bounds = cache.load_geojson(geojson_link)
         districts = bounds[bounds_on].unique()
         districts_arrests = df[df_on].unique()
 
@@ -22,32 +35,23 @@ def Choropleth(m, geojson_link, df, bounds_on, df_on, data_label, tooltip_labels
             if d not in ['UNVERIFIED',-1, 0] and d not in districts and (not test or test(d)):
                 raise ValueError(f"Unknown value: {d}")
         
-    
-    vc = df[df_on].astype(str).value_counts()
-    vc.name = data_label
-
-    bounds = bounds.drop_duplicates(subset=bounds_on)
-    bounds[bounds_on] = bounds[bounds_on].astype(str)
-
-    bounds = bounds.merge(vc, how='left', left_on=bounds_on, right_on=df_on)
-
-    geo = gpd.GeoSeries(bounds.set_index(bounds_on)['geometry']).to_json()
+    counts = region_counts(df, df_on, keys, value_counts)
+    counts.name = data_label
 
     num_bins = 10
     if not max_val:
-        max_val = bounds[data_label].max()
+        max_val = counts.max()
         bins = np.linspace(0, max_val, num_bins)
     else:
-        bins = np.append(np.linspace(0, max_val, num_bins-1), bounds[data_label].max())
+        bins = np.append(np.linspace(0, max_val, num_bins-1), counts.max())
 
 
     # https://towardsdatascience.com/how-to-step-up-your-folium-choropleth-map-skills-17cf6de7c6fe
     cp = folium.Choropleth(
         geo_data=geo,
-        data=bounds,
-        columns=[bounds_on, data_label],
+        data=counts,
         key_on = 'feature.id',
-        legend_name = '# of Arrests',
+        legend_name = f'# of {data_label}',
         nan_fill_color='White',
         highlight=True,
         bins=bins,
@@ -60,45 +64,118 @@ def Choropleth(m, geojson_link, df, bounds_on, df_on, data_label, tooltip_labels
             if key.startswith('color_map'):
                 del(cp._children[key])
 
+    labels = counts.fillna(0).astype(int).astype(str).to_dict()
     for row in cp.geojson.data['features']:
         row['properties'][bounds_on] = row['id']
-        if (tf:=bounds[bounds_on].apply(str)==row['id']).any():
-            val = bounds[data_label][tf].iloc[0]
-            if pd.notnull(val):
-                row['properties'][data_label] = str(int(val))
-            else:
-                row['properties'][data_label] = '0'
-        else:
-            row['properties'][data_label] = '0'
+        row['properties'][data_label] = labels.get(row['id'], '0')
         
+    if topo:
+        TopologyData(topo).add_to(cp.geojson)
     folium.GeoJsonTooltip([bounds_on,data_label],aliases=tooltip_labels).add_to(cp.geojson)
 
 
-def add_overlays(map_type, county_bounds, df_rem, m, geo_data, opacity, legend=True):
-    if map_type=='Individual Locations':
-        geo_j = gpd.GeoSeries(county_bounds.iloc[0]['geometry']).to_json()
-        geo_j = folium.GeoJson(data=geo_j, style_function=lambda x: {"fillOpacity": 0.0}, name='County Boundary')
+# Radius and blur (pixels) of the heat map of Individual Locations
+heatmap_radius = 4
+heatmap_blur = 1
+
+
+def aggregate_points(lat, lon, zoom, cell_px, max_cells=None):
+    # Heat map points are combined into cells of cell_px pixels when drawn (weighted center and summed weight).
+    # Combining them here into cells that are no larger at the given zoom gives the same map with fewer points.
+    # Returns rows of [lat, lon, weight]
+    if len(lat)==0:
+        return np.zeros((0,3))
+
+    # Size of a pixel in Web Mercator
+    lon_size = cell_px * 360 / (256 * 2**zoom)
+    lat_size = lon_size * np.cos(np.radians(lat.mean()))
+    ix = np.floor(lon/lon_size).astype(np.int64)
+    iy = np.floor(lat/lat_size).astype(np.int64)
+    cells, inverse, counts = np.unique((ix-ix.min()) * (iy.max()-iy.min()+1) + (iy-iy.min()), 
+                                        return_inverse=True, return_counts=True)
+    if max_cells and len(cells)>max_cells and zoom>0:
+        return aggregate_points(lat, lon, zoom-1, cell_px, max_cells)
+
+    return np.column_stack([np.bincount(inverse, lat)/counts, np.bincount(inverse, lon)/counts, counts])
+
+
+def heatmap_points(geometry):
+    # Points of the heat map of the locations of the selected rows as rows of [lat, lon, weight]. Rows without a location
+    # are not shown. Points are combined into cells at config.heatmap_zoom (see aggregate_points)
+    points = geometry[geometry.notnull()]
+    if config.heatmap_zoom:
+        return aggregate_points(points.y.to_numpy(), points.x.to_numpy(), config.heatmap_zoom,
+                                (heatmap_radius+heatmap_blur)/2, config.heatmap_max_cells)
+    return np.column_stack([points.y, points.x, np.ones(len(points))])
 
-        points = [[point.xy[1][0], point.xy[0][0]] for point in df_rem.geometry]
-        plugins.HeatMap(points, radius = 4, blur = 1, name="Data Plot").add_to(m)
-        geo_j.add_to(m)
+
+def add_county_boundary(county_bounds, m):
+    geom = county_bounds.iloc[0]['geometry']
+    if config.boundary_zoom:
+        geo_j, topo = topology.from_zoom([geom], ['0'], config.boundary_zoom)
+    else:
+        geo_j, topo = gpd.GeoSeries(geom).to_json(), None
+    geo_j = folium.GeoJson(data=geo_j, style_function=lambda x: {"fillOpacity": 0.0}, name='County Boundary')
+    if topo:
+        TopologyData(topo).add_to(geo_j)
+    geo_j.add_to(m)
+
+
+def record_label(partitions):
+    # Name of the records of partitions ((table type, year) of each dataset) for titles and legends, e.g. "Arrests", or
+    # "Records" if they are of more than 1 table type
+    table_types = {x[0] for x in partitions}
+    return table_types.pop().title() if len(table_types)==1 else 'Records'
+
+
+def add_overlays(map_type, df_rem, m, geo_data, opacity, legend=True, value_counts=None, label='Records'):
+    # value_counts: counts of the selected rows by geographic unit (see region_counts). df_rem is not needed with them
+    # label: name of the records in the legend and tooltips (see record_label)
+    if map_type=='Individual Locations':
+        with timing.span('heat map', rows=len(df_rem)):
+            points = heatmap_points(df_rem.geometry)
+            timing.annotate(points=len(points))
+            heat_map = CompactHeatMap if config.compact_points else plugins.HeatMap
+            heat_map(points, radius = heatmap_radius, blur = heatmap_blur, name="Data Plot").add_to(m)
     else:
-        Choropleth(m, geo_data[map_type]['geojson'], df_rem, geo_data[map_type]['bounds_on'], geo_data[map_type]['df_on'], 
-                'ARRESTS', [f'{map_type}:','# of Arrests: '], opacity=opacity, legend=legend)
-
-
-def add_markers(m):
-    df_markers = st.session_state['markers'].replace('',pd.NA).dropna(subset=['Latitude','Longitude'])
-    for k in st.session_state['marker_groups'].index:
-        members = df_markers['Group']==st.session_state['marker_groups'].loc[k, 'Name']
-        if members.any():
-            fg=folium.FeatureGroup(name=st.session_state['marker_groups'].loc[k, 'Name'], show=True)
-            m.add_child(fg)
-            for j in members[members].index:
-                color = st.session_state['marker_groups'].loc[k, 'Color'] if (c:=df_markers.loc[j, 'Color'])=='Group Color' else c
-                name = df_markers.loc[j, 'Name'] if pd.notnull(df_markers.loc[j, 'Name']) else None
-                folium.Marker([df_markers.loc[j, 'Latitude'], df_markers.loc[j, 'Longitude']], 
-                                tooltip=name,
-                                popup=name,
-                                icon=folium.Icon(color=color, icon=None)
-                                ).add_to(fg)
\ No newline at end of file
+        with timing.span('Choropleth', map_type=map_type, 
+                         rows=len(df_rem) if value_counts is None else int(value_counts.sum())):
+            Choropleth(m, geo_data[map_type]['geojson'], df_rem, geo_data[map_type]['bounds_on'], geo_data[map_type]['df_on'], 
+                    label, [f'{map_type}:',f'# of {label}: '], opacity=opacity, legend=legend, value_counts=value_counts)
+
+
+def add_markers(m, markers, marker_groups):
+    # Each group is a layer with all of its markers in 1 element: a GeoJSON FeatureCollection or, with compact_points,
+    # the compact encoding
+    df_markers = marker_store.for_map(markers, marker_groups)
+    marker_layer = CompactMarkers if config.compact_points else GeoJsonMarkers
+    for name, group in df_markers.groupby('Group', sort=False, observed=True):
+        fg = folium.FeatureGroup(name=name, show=True)
+        m.add_child(fg)
+        marker_layer(group['Latitude'], group['Longitude'], group['Color'], group['Name']).add_to(fg)
+
+
+# Rendered layers that are added to the map with layers.add_to. The data layers are identified by the dataset, the
+# selection key of the filters (filters.selection_key) and the display settings instead of hashing the selected rows.
+# The selected rows (cache.get_selection) are only taken from the data when the layers are not cached and only for the
+# heat map. Choropleths are counted from the aggregate cube of the dataset (cache.value_counts)
+@caching.cache_resource(show_spinner=False, max_entries=config.layer_cache_entries)
+def get_data_layers(map_type, dataset, selection, opacity, legend, _df, _rows, _index):
+    label = record_label(dataset[0])
+    def build(m):
+        if map_type=='Individual Locations':
+            add_overlays(map_type, filters.take(_df, _rows), m, config.geo_data, opacity, legend, label=label)
+        else:
+            value_counts = cache.value_counts(dataset, selection, config.geo_data[map_type]['df_on'], _index, _df)
+            add_overlays(map_type, None, m, config.geo_data, opacity, legend, value_counts, label)
+    return layers.render_layers(build)
+
+
+@caching.cache_resource(show_spinner=False)
+def get_county_layers():
+    return layers.render_layers(lambda m: add_county_boundary(cache.get_county_bounds(), m))
+
+
+@caching.cache_resource(show_spinner=False, max_entries=config.layer_cache_entries)
+def get_marker_layers(markers, marker_groups):
+    return layers.render_layers(lambda m: add_markers(m, markers, marker_groups))
@@ -0,0 +1,123 @@
+import pandas as pd
+
+# Markers and marker groups of the map. Markers have the columns Name, Latitude, Longitude, Group, and Color (a marker
+# color or group_color to use the color of the group). Groups have the columns Name and Color. Imports are validated and
+# merged and table edits are applied to whole columns at once instead of row by row so that tables with thousands of
+# markers stay fast. Tables are kept with a default index (0..n-1) so that row labels are also row positions.
+
+group_color = 'Group Color'
+colors = ['red', 'blue', 'green', 'purple', 'orange', 'darkred', 'lightred',
+          'beige', 'darkblue', 'darkgreen', 'cadetblue', 'darkpurple', 'white',
+          'pink', 'lightblue', 'lightgreen', 'gray', 'black', 'lightgray']
+default_color = 'blue'
+default_group = 'Default Group'
+
+marker_columns = ['Name','Latitude','Longitude','Group','Color']
+group_columns = ['Name','Color']
+
+
+def empty():
+    # Markers and groups of a new session
+    return pd.DataFrame(columns=marker_columns), pd.DataFrame({'Name': [default_group], 'Color': [default_color]})
+
+
+def read_export(data):
+    # Markers and groups of a file from Export Markers (loaded JSON). Raises ValueError if the file is not in that format
+    if not isinstance(data, dict) or set(data)!={'markers', 'marker_groups'}:
+        raise ValueError("File does not contain (only) markers and marker_groups")
+    try:
+        markers = pd.DataFrame(data['markers'])
+        groups = pd.DataFrame(data['marker_groups'])
+    except (TypeError, ValueError) as e:
+        raise ValueError(f"Markers and marker groups are not tables: {e}")
+    for df, columns in [(markers, marker_columns), (groups, group_columns)]:
+        if (unknown:=set(df.columns) - set(columns)):
+            raise ValueError(f"Unknown column(s) {sorted(unknown)}")
+    return markers.reindex(columns=marker_columns), groups.reindex(columns=group_columns)
+
+
+def _blank(x):
+    return x.isnull() | (x.astype(str).str.strip()=='')
+
+
+def clean_markers(markers):
+    # Markers with numeric locations (markers without a valid location are dropped), a group, and a known color.
+    # Returns the markers and the number of markers dropped
+    markers = markers.reindex(columns=marker_columns)
+    lat = pd.to_numeric(markers['Latitude'], errors='coerce')
+    lon = pd.to_numeric(markers['Longitude'], errors='coerce')
+    valid = lat.between(-90, 90) & lon.between(-180, 180)
+    markers = markers.assign(
+        Name=markers['Name'].where(~_blank(markers['Name']), '').astype(str),
+        Latitude=lat,
+        Longitude=lon,
+        Group=markers['Group'].where(~_blank(markers['Group']), default_group).astype(str),
+        Color=markers['Color'].where(markers['Color'].isin(colors), group_color),
+    )
+    return markers[valid], int((~valid).sum())
+
+
+def clean_groups(groups):
+    # Groups with a name and a known color. Only the first group with each name is kept
+    groups = groups.reindex(columns=group_columns)
+    groups = groups[~_blank(groups['Name'])]
+    groups = groups.assign(Name=groups['Name'].astype(str), Color=groups['Color'].where(groups['Color'].isin(colors),
+                                                                                        default_color))
+    return groups.drop_duplicates(subset='Name')
+
+
+def merge(markers, marker_groups, imports):
+    # Adds the markers and groups of each import (list of (markers, marker_groups)) to the current tables. Imported
+    # markers that are already in the table are dropped. Current groups keep their colors and groups that are only used
+    # by markers are added with the default color. Returns markers, marker_groups, and the number of invalid markers
+    if len(imports)==0:
+        return markers, marker_groups, 0
+
+    new_markers, dropped = clean_markers(pd.concat([x[0] for x in imports], ignore_index=True))
+    current = pd.MultiIndex.from_frame(clean_markers(markers)[0].astype(str))
+    new_markers = new_markers.drop_duplicates()
+    new_markers = new_markers[~pd.MultiIndex.from_frame(new_markers.astype(str)).isin(current)]
+    markers = pd.concat([markers, new_markers], ignore_index=True) if len(markers)>0 else \
+        new_markers.reset_index(drop=True)
+
+    groups = [marker_groups] + [x[1] for x in imports] + \
+        [pd.DataFrame({'Name': markers['Group'].unique(), 'Color': default_color})]
+    marker_groups = clean_groups(pd.concat(groups, ignore_index=True)).reset_index(drop=True)
+    return markers, marker_groups, dropped
+
+
+def apply_edits(df, edits):
+    # Applies the changes of a st.data_editor (edited_rows, added_rows, and deleted_rows, which are row positions of
+    # the table before the changes) to df. Edits are applied 1 column at a time
+    df = df.reset_index(drop=True)
+    columns = {}
+    for position, updates in edits.get('edited_rows', {}).items():
+        for k,v in updates.items():
+            columns.setdefault(k, ([], []))
+            columns[k][0].append(int(position))
+            columns[k][1].append(v)
+    for k, (positions, values) in columns.items():
+        if k not in df.columns:
+            df[k] = None
+        if df[k].dtype!=object and not all(isinstance(v, (int, float)) for v in values):
+            df[k] = df[k].astype(object)
+        df.loc[positions, k] = values
+
+    if (added:=edits.get('added_rows')):
+        df = pd.concat([df, pd.DataFrame(added, columns=df.columns)], ignore_index=True)
+    if (deleted:=edits.get('deleted_rows')):
+        df = df.drop(index=deleted).reset_index(drop=True)
+    return df
+
+
+def for_map(markers, marker_groups):
+    # Markers to plot: markers with a valid location in one of the groups with the color of the group filled in and names
+    # that are None for no name. Markers are sorted in the order of the groups
+    markers, _ = clean_markers(markers)
+    groups = clean_groups(marker_groups).set_index('Name')['Color']
+    markers = markers[markers['Group'].isin(groups.index)]
+    return markers.assign(
+        Name=markers['Name'].astype(object).where(markers['Name']!='', None),
+        Color=markers['Color'].where(markers['Color']!=group_color, markers['Group'].map(groups)),
+        Group=pd.Categorical(markers['Group'], categories=groups.index),
+    ).sort_values('Group', kind='stable')
@@ -0,0 +1,57 @@
+import glob
+import os
+
+import pandas as pd
+
+# Sources of the standardized tables. OpdSource loads them from OpenPoliceData. LocalSource is a stand-in that reads
+# CSV files of standardized tables (i.e. for testing or for working without network access). openpolicedata is only
+# imported when it is used since importing it is slow (it downloads its list of sources)
+
+class OpdSource:
+    remote = True
+
+    def __init__(self, source_name="Fairfax County"):
+        self.source_name = source_name
+
+    def years(self):
+        # Dictionary of table type: years available
+        import openpolicedata as opd
+        src = opd.Source(source_name=self.source_name)
+        return {t:list(src.get_years(t)) for t in src.datasets['TableType'].unique()}
+
+    def load(self, table_type, year, start=None):
+        # start: optional date (YYYY-MM-DD). Only records on or after start are loaded
+        import openpolicedata as opd
+        src = opd.Source(source_name=self.source_name)
+        if start:
+            table = src.load(table_type, date=[start, f"{year}-12-31"])
+        else:
+            table = src.load(table_type, year=year)
+        table.standardize()
+        return table.table
+
+
+class LocalSource:
+    # Tables are read from files named <table type>_<year>.csv in directory, e.g. ARRESTS_2022.csv
+    remote = False
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def years(self):
+        years = {}
+        for path in glob.glob(os.path.join(self.directory, '*_*.csv')):
+            table_type, year = os.path.basename(path)[:-len('.csv')].rsplit('_', 1)
+            years.setdefault(table_type, []).append(int(year))
+        return years
+
+    def load(self, table_type, year, start=None):
+        # Tables without dates are loaded whole (start cannot be applied to them)
+        import openpolicedata as opd
+        date = opd.defs.columns.DATE
+        df = pd.read_csv(os.path.join(self.directory, f"{table_type}_{year}.csv"))
+        if date in df:
+            df[date] = pd.to_datetime(df[date])
+            if start:
+                df = df[df[date]>=start].reset_index(drop=True)
+        return df
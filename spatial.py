@@ -0,0 +1,21 @@
+import numpy as np
+import pandas as pd
+
+
+def assign_regions(points, bounds, bounds_on):
+    # Value of bounds_on for the boundary containing each point using the spatial index (STRtree) of the boundaries.
+    # Points on a shared border are assigned to one of the boundaries. Points outside of all boundaries or
+    # without a location are not assigned (NaN)
+    valid = np.flatnonzero(points.notnull().to_numpy())
+    pt_idx, bounds_idx = bounds.sindex.query(points.values[valid], predicate='intersects')
+    pt_idx, first = np.unique(pt_idx, return_index=True)
+
+    result = np.full(len(points), np.nan, dtype=object)
+    result[valid[pt_idx]] = bounds[bounds_on].to_numpy()[bounds_idx[first]]
+    # Nullable types so that integer names are not converted to floats by the missing values
+    return pd.Series(result, index=points.index, name=bounds_on).convert_dtypes()
+
+
+def join_regions(points, layers):
+    # layers: dictionary of output column name: (boundaries, name of column in boundaries with the region name)
+    return pd.DataFrame({col: assign_regions(points, bounds, bounds_on) for col, (bounds, bounds_on) in layers.items()})
@@ -0,0 +1,143 @@
+import glob
+import json
+import os
+import re
+import tempfile
+import threading
+import time
+import warnings
+
+import geopandas as gpd
+import pandas as pd
+import pyarrow.parquet as pq
+
+import config
+
+# Persistent copies of the standardized, reprojected datasets so that new server processes do not
+# need to download them again. Files are GeoParquet named after their key, e.g.
+# Fairfax-County_ARRESTS_2022.parquet. Setting FCPD_OFFLINE=1 only uses stored (or pre-seeded) files.
+
+_rename_lock = threading.Lock()
+
+
+def key_to_path(key):
+    name = '_'.join(re.sub(r'[^\w.-]+', '-', str(k)).strip('-') for k in key)
+    return os.path.join(config.store_dir, name+'.parquet')
+
+
+def _meta_path(path):
+    return path[:-len('.parquet')]+'.json'
+
+
+def read_meta(path):
+    try:
+        with open(_meta_path(path)) as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+
+def is_fresh(path, ttl):
+    return os.path.exists(path) and (ttl is None or time.time()-os.path.getmtime(path) < ttl)
+
+
+def read(key):
+    path = key_to_path(key)
+    if b'geo' in (pq.read_schema(path).metadata or {}):
+        return gpd.read_parquet(path, memory_map=True)
+    else:
+        return pd.read_parquet(path, memory_map=True)
+
+
+def write(key, gdf, version=None, appended=None):
+    path = key_to_path(key)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    gdf = gdf.copy(deep=False)
+    for col in gdf.columns[gdf.dtypes==object]:
+        # Arrow requires a single type per column. Columns such as Patrol Area mix numbers and names
+        # so they are stored as text
+        if gdf[col].dropna().map(type).nunique()>1:
+            gdf[col] = gdf[col].where(gdf[col].isnull(), gdf[col].astype(str))
+
+    # Both files are written to unique temporary files first and then renamed so that other processes and sessions (which
+    # are threads of the same process) never read a partial file, even when they write the same key at the same time.
+    # The metadata is written before either file is renamed and both are renamed together so that the table is not paired
+    # with the metadata of another write
+    meta = json.dumps({'key': list(key), 'version': version, 'saved': time.time(), 'appended': appended})
+    tmp = _temp_file(path)
+    tmp_meta = _temp_file(path)
+    try:
+        gdf.to_parquet(tmp)
+        with open(tmp_meta, 'w') as f:
+            f.write(meta)
+        with _rename_lock:
+            os.replace(tmp, path)
+            os.replace(tmp_meta, _meta_path(path))
+    finally:
+        for x in [tmp, tmp_meta]:
+            if os.path.exists(x):
+                os.remove(x)
+
+
+def _temp_file(path):
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix=os.path.basename(path)+'.', suffix='.tmp')
+    os.close(fd)
+    return tmp
+
+
+def stored_keys():
+    # Keys of the stored datasets. Files saved before keys were recorded in the metadata are not included
+    keys = []
+    for path in glob.glob(os.path.join(config.store_dir, '*.json')):
+        meta = read_meta(path[:-len('.json')]+'.parquet')
+        if 'key' in meta and os.path.exists(path[:-len('.json')]+'.parquet'):
+            keys.append(tuple(meta['key']))
+    return keys
+
+
+def load(key, loader, ttl=None, version=None, remote=True, update=None):
+    # key: tuple identifying the dataset, e.g. (source, table type, year)
+    # loader: function that fetches the dataset when there is no valid stored copy
+    # ttl: seconds that a stored copy is used before it is checked again. None never expires
+    # version: optional function returning a cheap version token (i.e. ETag or last edit date). When the ttl
+    #     has expired and the token matches the stored one, the stored copy is renewed instead of fetched again
+    # remote: whether loader requires network access. Only remote datasets are limited to stored files in offline mode
+    # update: optional function that is passed the stored copy when it has expired and returns it with any new records
+    #     appended (or None if it cannot be updated and must be loaded again). The number of rows that the new records were
+    #     appended to is saved in the metadata as appended
+    path = key_to_path(key)
+    exists = os.path.exists(path)
+    offline = config.offline and remote
+    if exists and (offline or is_fresh(path, ttl)):
+        return read(key)
+    elif offline:
+        raise FileNotFoundError(f"Offline mode is enabled and {path} has not been stored")
+
+    token = None
+    if version:
+        try:
+            token = version()
+        except Exception:
+            pass
+        if exists and token is not None and token==read_meta(path).get('version'):
+            os.utime(path)
+            return read(key)
+
+    try:
+        gdf = appended = None
+        if exists and update:
+            stored = read(key)
+            if (gdf:=update(stored)) is not None:
+                appended = len(stored)
+        if gdf is None:
+            gdf = loader()
+    except Exception as e:
+        if exists:
+            warnings.warn(f"Unable to update {os.path.basename(path)} ({e}). Using copy stored on "+
+                          time.strftime('%Y-%m-%d %H:%M', time.localtime(os.path.getmtime(path))))
+            return read(key)
+        raise
+
+    write(key, gdf, version=token, appended=appended)
+    return gdf
@@ -1,14 +1,30 @@
 import pandas as pd
 import streamlit as st
 
+import caching
+import marker_store
+
+
+def use_streamlit():
+    # The cached functions of the data and rendering code (see caching.py) use Streamlit's caches in the dashboard so
+    # that they are shared by all sessions, and slow loads show a spinner
+    caching.set_backend(lambda kind, func, options: (st.cache_data if kind=='data' else st.cache_resource)(func, **options),
+                        st.spinner)
+
+
+def timing_panel(trace, stats=None):
+    # Spans of the current rerun (see timing.py) and statistics of the shared caches in the sidebar
+    record = trace.to_dict()
+    with st.sidebar.expander("Performance", expanded=True):
+        st.caption(f"Rerun: {record['seconds']*1000:,.0f} ms")
+        st.dataframe(pd.DataFrame({
+            'Stage': ['\u2003'*x['depth'] + x['name'] for x in record['spans']],
+            'ms': [None if x['seconds'] is None else round(x['seconds']*1000, 1) for x in record['spans']],
+            'Details': [', '.join(f"{k}={v}" for k,v in x['attrs'].items()) for x in record['spans']],
+        }), hide_index=True)
+        if stats:
+            st.dataframe(pd.DataFrame(stats).T, column_config={'_index': 'Cache'})
+
+
 def data_editor_on_change(data_editor_key, df_key):
-    state = st.session_state[data_editor_key]
-    for index, updates in state["edited_rows"].items():
-        for key, value in updates.items():
-            st.session_state[df_key].loc[st.session_state[df_key].index == index, key] = value
-    for updates in state["added_rows"]:
-        st.session_state[df_key] = pd.concat([st.session_state[df_key], 
-                                                    pd.DataFrame(updates,index=[0])],
-                                                    ignore_index=True)
-    for index in state["deleted_rows"]:
-        st.session_state[df_key] = st.session_state[df_key].drop(index=index)
\ No newline at end of file
+    st.session_state[df_key] = marker_store.apply_edits(st.session_state[df_key], st.session_state[data_editor_key])
@@ -0,0 +1,95 @@
+import io
+import time
+
+import pytest
+
+import geocoding
+
+# Geocoding of marker addresses through a local backend (geocoding.StubBackend)
+
+locations = {'12000 Government Center Pkwy, Fairfax, VA': (38.8530, -77.3566),
+             '4100 Chain Bridge Rd, Fairfax, VA': (38.8462, -77.3064),
+             '1600 Pennsylvania Ave, Washington, DC': (38.8977, -77.0365),
+             '1 Main St, Los Angeles, CA': (34.0522, -118.2437)}
+center = (38.8462, -77.3064)
+
+
+class CountingBackend(geocoding.StubBackend):
+    # Records the time of each lookup. Lookups of error_address fail (i.e. network errors)
+    error_address = 'error'
+
+    def __init__(self, locations, rate=None):
+        super().__init__(locations)
+        self.rate = rate
+        self.calls = []
+
+    def geocode(self, address):
+        self.calls.append((address, time.monotonic()))
+        if address==self.error_address:
+            raise ConnectionError("Unable to connect")
+        return super().geocode(address)
+
+
+@pytest.fixture
+def cache_path(tmp_path):
+    return str(tmp_path / 'geocode.sqlite')
+
+
+def test_cache_is_used_for_second_lookup(cache_path):
+    backend = CountingBackend(locations)
+    geocoder = geocoding.Geocoder(backend, cache_path)
+    addresses = ['12000 Government Center Pkwy, Fairfax, VA', 'unknown address']
+    assert geocoder.geocode_many(addresses) == [locations[addresses[0]], None]
+    assert len(backend.calls)==2
+
+    # Addresses that were not found are cached as well. Case and whitespace do not matter
+    assert geocoder.geocode_many(['12000  GOVERNMENT Center Pkwy, Fairfax, VA ', 'Unknown Address']) == \
+        [locations[addresses[0]], None]
+    assert len(backend.calls)==2
+
+    # The cache is shared by geocoders of the same database
+    other = CountingBackend(locations)
+    assert geocoding.Geocoder(other, cache_path).geocode(addresses[0])==locations[addresses[0]]
+    assert len(other.calls)==0
+
+
+def test_rate_limiter_spaces_lookups(cache_path):
+    rate = 20
+    backend = CountingBackend(locations, rate=rate)
+    geocoder = geocoding.Geocoder(backend, cache_path, workers=4)
+    assert geocoder.geocode_many(list(locations)) == list(locations.values())
+
+    times = sorted(t for _, t in backend.calls)
+    assert len(times)==len(locations)
+    # Small tolerance for the resolution of the clock
+    assert min(b-a for a,b in zip(times, times[1:])) >= 1/rate - 0.005
+
+
+def test_addresses_that_cannot_be_geocoded_are_reported(cache_path):
+    backend = CountingBackend(locations)
+    geocoder = geocoding.Geocoder(backend, cache_path)
+    file = io.StringIO('Address,Name,Group\n'
+                       '"12000 Government Center Pkwy, Fairfax, VA",Government Center,County\n'
+                       '"4100 Chain Bridge Rd, Fairfax, VA",,\n'
+                       'unknown address,Nowhere,\n'
+                       ',No address,\n'
+                       'error,Failed lookup,\n'
+                       '"1 Main St, Los Angeles, CA",Far away,\n')
+    addresses = geocoding.read_addresses(file)
+    assert len(addresses)==5
+
+    markers, not_found, far = geocoding.to_markers(addresses, geocoder.geocode_many(addresses['Address']), center)
+    assert list(markers['Name'])==['Government Center', '']
+    assert list(markers['Group'])==['County', '']
+    assert not_found==['unknown address', 'error']
+    assert [x for x,_ in far]==['1 Main St, Los Angeles, CA']
+    assert far[0][1]>2000
+
+    # Failed lookups are not cached
+    geocoder.geocode_many(['error'])
+    assert [x for x,_ in backend.calls].count('error')==2
+
+
+def test_read_addresses_requires_address_column():
+    with pytest.raises(ValueError):
+        geocoding.read_addresses(io.StringIO('Name,Group\nHome,\n'))
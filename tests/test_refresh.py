@@ -0,0 +1,118 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import cache
+import config
+import filters
+import store
+
+# Refreshing stored partitions (cache.update_partition) and the combined table of a dataset (cache.Dataset) with
+# records that are added to a sources.LocalSource
+
+partition = ('ARRESTS', 2022)
+
+
+def _record(date, race='WHITE', statute='18.2-1'):
+    return {'X Coordinate': 11800000.0, 'Y Coordinate': 7000000.0, 'Statute': statute, 'Statute Description': 'STATUTE',
+            'IBR Code': '13A', 'IBR Description': 'ASSAULT', 'SUBJECT_RE_GROUP': race, 'Patrol Area': '1',
+            'DATE': date}
+
+
+@pytest.fixture
+def source(tmp_path, monkeypatch):
+    # Writes the records of the source table. Stored partitions are always expired so that each load checks the source
+    monkeypatch.setattr(config, 'store_dir', str(tmp_path / 'store'))
+    monkeypatch.setattr(config, 'source_dir', str(tmp_path))
+    monkeypatch.setattr(config, 'offline', False)
+    monkeypatch.setattr(config, 'data_ttl', 0)
+
+    def write(records):
+        pd.DataFrame(records).to_csv(tmp_path / f'{partition[0]}_{partition[1]}.csv', index=False)
+    return write
+
+
+def _stored():
+    return store.read(("Fairfax County",)+partition)
+
+
+def _values(index, col):
+    # Value of col of each row from the index
+    col_index = index['columns'][col]
+    return list(col_index['categories'].take(col_index['codes']))
+
+
+def test_update_partition_appends_new_records_of_watermark_day(source):
+    first = [_record('2022-01-01 10:00'), _record('2022-01-03 08:00'), _record('2022-01-03 09:00', race='BLACK')]
+    source(first)
+    cache.load_partition(*partition)
+    assert len(_stored())==3
+
+    # The source now has a second (identical) record at 9:00 and a record later on the day of the watermark
+    later = [_record('2022-01-03 09:00', race='BLACK'), _record('2022-01-03 20:00', race='ASIAN'),
+             _record('2022-01-04 10:00', statute='18.2-2')]
+    source(first + later)
+    df = cache.load_partition(*partition)
+    assert len(df)==6
+    assert store.read_meta(store.key_to_path(("Fairfax County",)+partition))['appended']==3
+    assert list(df['DATE'].iloc[3:])==list(pd.to_datetime([x['DATE'] for x in later]))
+    assert (df['SUBJECT_RE_GROUP']=='BLACK').sum()==2
+
+    # Nothing is added when the source has not changed
+    assert len(cache.load_partition(*partition))==6
+
+
+def test_update_partition_keeps_duplicate_records_of_source(source):
+    duplicate = _record('2022-01-02 12:00')
+    source([_record('2022-01-01 10:00'), duplicate, duplicate])
+    cache.load_partition(*partition)
+    assert len(_stored())==3
+
+    source([_record('2022-01-01 10:00'), duplicate, duplicate, duplicate])
+    assert len(cache.load_partition(*partition))==4
+
+
+def test_dataset_appends_to_table_and_index(source):
+    first = [_record('2022-01-01 10:00'), _record('2022-01-03 08:00', race='BLACK')]
+    source(first)
+    dataset = cache.Dataset((partition,))
+    df, _, index = dataset.get()
+    version = df.attrs['version']
+
+    source(first + [_record('2022-01-03 20:00', race='ASIAN', statute='18.2-2'), _record('2022-01-05 10:00')])
+    df, races, index = dataset.get()
+    assert len(df)==4
+    assert df.attrs['version']!=version
+    assert set(races)=={'WHITE', 'BLACK', 'ASIAN'}
+
+    # Values that are new to the index are added after the existing ones so only the rows and values are compared
+    expected = filters.build_index(df, cache.filter_columns())
+    assert index['n']==expected['n']
+    for col, col_index in expected['columns'].items():
+        assert _values(index, col)==_values(expected, col)
+        counts = dict(zip(index['columns'][col]['categories'], index['columns'][col]['counts']))
+        assert counts==dict(zip(col_index['categories'], col_index['counts']))
+        for value, positions in zip(index['columns'][col]['categories'], index['columns'][col]['positions']):
+            assert np.array_equal(positions, col_index['positions'][col_index['lookup'][filters._key(value)]])
+
+    # The version does not change when there are no new records
+    version = df.attrs['version']
+    assert dataset.get()[0].attrs['version']==version
+
+
+def test_dataset_rebuilds_replaced_partition(source):
+    source([_record('2022-01-01 10:00'), _record('2022-01-02 10:00')])
+    dataset = cache.Dataset((partition,))
+    df, _, _ = dataset.get()
+    version = df.attrs['version']
+
+    # A partition that is loaded again with the same number of rows is a new version of the table. The source is removed
+    # so that the stored copy is used as is
+    store.write(("Fairfax County",)+partition, cache.fetch_data(*partition))
+    os.remove(os.path.join(config.source_dir, f'{partition[0]}_{partition[1]}.csv'))
+    with pytest.warns(UserWarning, match='Unable to update'):
+        df, _, _ = dataset.get()
+    assert len(df)==2
+    assert df.attrs['version']!=version
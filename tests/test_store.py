@@ -0,0 +1,40 @@
+import pandas as pd
+import pytest
+
+import config
+import store
+
+# Offline mode (config.offline), which only uses the files of a pre-seeded store for remote datasets
+
+key = ("Fairfax County", "ARRESTS", 2022)
+
+
+@pytest.fixture
+def offline(tmp_path, monkeypatch):
+    monkeypatch.setattr(config, 'store_dir', str(tmp_path / 'store'))
+    monkeypatch.setattr(config, 'offline', True)
+
+
+def fail():
+    raise AssertionError("The loader must not be called in offline mode")
+
+
+def test_offline_returns_stored_copy(offline):
+    df = pd.DataFrame({'Race': ['WHITE', 'BLACK'], 'Count': [1, 2]})
+    store.write(key, df)
+    # The stored copy is used even after its ttl (and without checking its version or updating it)
+    loaded = store.load(key, fail, ttl=0, version=fail, update=lambda stored: fail())
+    pd.testing.assert_frame_equal(loaded, df)
+
+
+def test_offline_missing_remote_key(offline):
+    with pytest.raises(FileNotFoundError, match='Offline mode'):
+        store.load(key, fail)
+    assert store.stored_keys()==[]
+
+
+def test_offline_loads_local_key(offline):
+    # Datasets that do not require network access are still loaded and stored
+    df = pd.DataFrame({'Region': ['A']})
+    pd.testing.assert_frame_equal(store.load(key+('regions',), lambda: df, remote=False), df)
+    assert store.stored_keys()==[key+('regions',)]
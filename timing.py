@@ -0,0 +1,91 @@
+import contextlib
+import contextvars
+import json
+import logging
+import threading
+import time
+
+import config
+
+# Timing of the stages of a dashboard rerun. A trace is started for each rerun and the spans entered while it is active
+# (in the same thread) are recorded with their attributes (i.e. cache hit/miss, rows, bytes). Finished traces are
+# written as 1 JSON line to the fcpd.timing logger and to the file config.timing_log so that they can be aggregated
+# across sessions. Spans outside of a trace are not recorded so they cost almost nothing.
+
+logger = logging.getLogger('fcpd.timing')
+if config.timing_log:
+    _handler = logging.FileHandler(config.timing_log)
+    _handler.setFormatter(logging.Formatter('%(message)s'))
+    logger.addHandler(_handler)
+    logger.setLevel(logging.INFO)
+
+_trace = contextvars.ContextVar('trace', default=None)
+_span = contextvars.ContextVar('span', default=None)
+
+
+class Trace:
+    def __init__(self, name, **attrs):
+        self.name = name
+        self.attrs = attrs
+        self.spans = []
+        self.time = time.time()
+        self._start = time.perf_counter()
+        self._lock = threading.Lock()
+
+    def elapsed(self):
+        return time.perf_counter() - self._start
+
+    def to_dict(self):
+        with self._lock:
+            spans = [dict(x, attrs=dict(x['attrs'])) for x in self.spans]
+        return {'trace': self.name, 'time': self.time, 'seconds': self.elapsed(), **self.attrs, 'spans': spans}
+
+
+def start(name, **attrs):
+    # Starts a trace in this thread (i.e. at the start of a rerun) and returns it
+    trace = Trace(name, **attrs)
+    _trace.set(trace)
+    _span.set(None)
+    return trace
+
+
+def current():
+    return _trace.get()
+
+
+def finish():
+    # Logs the trace of this thread and stops recording
+    trace = _trace.get()
+    if trace is not None:
+        _trace.set(None)
+        logger.info(json.dumps(trace.to_dict(), default=str))
+    return trace
+
+
+@contextlib.contextmanager
+def span(name, **attrs):
+    trace = _trace.get()
+    if trace is None:
+        yield None
+        return
+
+    parent = _span.get()
+    record = {'name': name, 'depth': 0 if parent is None else parent['depth']+1, 'start': trace.elapsed(),
+              'seconds': None, 'attrs': attrs}
+    with trace._lock:
+        # Spans are listed in the order that they start
+        trace.spans.append(record)
+    token = _span.set(record)
+    t = time.perf_counter()
+    try:
+        yield record
+    finally:
+        record['seconds'] = time.perf_counter() - t
+        _span.reset(token)
+
+
+def annotate(**attrs):
+    # Adds attributes to the innermost span
+    record = _span.get()
+    if record is not None:
+        record['attrs'].update(attrs)
@@ -0,0 +1,134 @@
+import json
+
+import numpy as np
+import shapely
+
+# Boundaries in TopoJSON format (https://github.com/topojson/topojson-specification). Polygons are split into arcs at the
+# points where they stop sharing a border so that each shared border is only sent once. Coordinates are quantized to
+# integers on a grid and delta encoded. Before that, boundaries are simplified as a coverage so that the shared borders
+# are simplified the same way for both polygons and no gaps or overlaps are created. The topology is decoded in the
+# page by encoding.TopologyData.
+
+
+def zoom_tolerance(zoom, lat):
+    # Size (degrees) of half of a pixel at the zoom level
+    return 0.5 * 360 / (256 * 2**zoom) * np.cos(np.radians(lat))
+
+
+def simplify(geoms, tolerance):
+    # Simplification of polygons that share borders (see shapely.coverage_simplify)
+    geoms = np.asarray(geoms, dtype=object)
+    return shapely.coverage_simplify(geoms, tolerance) if len(geoms)>0 else geoms
+
+
+def _rings(geoms):
+    # Exterior and interior rings of each polygon. Returns the ring coordinates and the structure of each
+    # geometry as nested lists of ring indices
+    rings = []
+    structure = []
+    for geom in geoms:
+        polygons = []
+        for polygon in (geom.geoms if geom.geom_type=='MultiPolygon' else [geom]):
+            if polygon.is_empty:
+                continue
+            polygon_rings = []
+            for ring in [polygon.exterior, *polygon.interiors]:
+                polygon_rings.append(len(rings))
+                rings.append(shapely.get_coordinates(ring))
+            polygons.append(polygon_rings)
+        structure.append(polygons)
+    return rings, structure
+
+
+def to_topology(geoms, grid):
+    # geoms: polygons or multipolygons (in WGS84). grid: size (degrees) of the grid that coordinates are quantized to
+    # Returns a topology with a GeometryCollection object named data with the geometries in the same order
+    rings, structure = _rings(geoms)
+    all_points = np.concatenate(rings) if rings else np.zeros((0,2))
+    translate = all_points.min(axis=0) if len(all_points)>0 else np.zeros(2)
+
+    # Quantized points of each ring without the repeated last point or consecutive duplicates
+    keys = []
+    for ring in rings:
+        q = np.rint((ring[:-1]-translate)/grid).astype(np.int64)
+        q = q[np.any(q!=np.roll(q, 1, axis=0), axis=1)] if len(q)>1 else q
+        keys.append(q[:,0]<<32 | q[:,1])
+
+    # A point is a junction if it does not have the same 2 neighbors in all rings that it is in (i.e. where 2 polygons
+    # stop sharing a border)
+    ring_keys = [k for k in keys if len(k)>=3]
+    if ring_keys:
+        k = np.concatenate(ring_keys)
+        prev = np.concatenate([np.roll(x, 1) for x in ring_keys])
+        nxt = np.concatenate([np.roll(x, -1) for x in ring_keys])
+        neighbors = np.unique(np.column_stack([k, np.minimum(prev, nxt), np.maximum(prev, nxt)]), axis=0)
+        points, counts = np.unique(neighbors[:,0], return_counts=True)
+        junctions = set(points[counts>1].tolist())
+    else:
+        junctions = set()
+
+    arcs = []
+    arc_ids = {}
+    def arc_index(arc):
+        # Index of the arc (or ~index if reversed) so that each arc is only stored once
+        arc = tuple(arc)
+        if arc in arc_ids:
+            return arc_ids[arc]
+        elif arc[::-1] in arc_ids:
+            return ~arc_ids[arc[::-1]]
+        arc_ids[arc] = len(arcs)
+        arcs.append(arc)
+        return arc_ids[arc]
+
+    ring_arcs = []
+    for ring in keys:
+        if len(ring)<3:
+            ring_arcs.append(None)
+            continue
+        ring = ring.tolist()
+        cuts = [i for i,x in enumerate(ring) if x in junctions]
+        if len(cuts)==0:
+            # Rings without junctions are only shared if they are identical so start at the same point
+            start = ring.index(min(ring))
+            ring = ring[start:] + ring[:start]
+            ring_arcs.append([arc_index(ring + ring[:1])])
+            continue
+        ring = ring[cuts[0]:] + ring[:cuts[0]+1]
+        cuts = [i-cuts[0] for i in cuts] + [len(ring)-1]
+        ring_arcs.append([arc_index(ring[a:b+1]) for a,b in zip(cuts[:-1], cuts[1:])])
+
+    geometries = []
+    for polygons in structure:
+        # Polygons whose exterior collapsed to a point or line are dropped
+        polygons = [[ring_arcs[r] for r in p if ring_arcs[r] is not None] for p in polygons if ring_arcs[p[0]] is not None]
+        if len(polygons)==0:
+            geometries.append({'type': None})
+        elif len(polygons)==1:
+            geometries.append({'type': 'Polygon', 'arcs': polygons[0]})
+        else:
+            geometries.append({'type': 'MultiPolygon', 'arcs': polygons})
+
+    encoded = []
+    for arc in arcs:
+        a = np.array(arc, dtype=np.int64)
+        q = np.column_stack([a>>32, a & 0xFFFFFFFF])
+        encoded.append(np.diff(q, axis=0, prepend=np.zeros((1,2), dtype=np.int64)).tolist())
+
+    return {
+        'type': 'Topology',
+        'transform': {'scale': [grid, grid], 'translate': translate.tolist()},
+        'objects': {'data': {'type': 'GeometryCollection', 'geometries': geometries}},
+        'arcs': encoded,
+    }
+
+
+def from_zoom(geoms, ids, zoom):
+    # Boundaries simplified to half of a pixel at the zoom level (and quantized to an eighth of a pixel) so that
+    # they look the same up to that zoom. Returns features (GeoJSON) with the ids and no geometries, which can be used
+    # with folium.GeoJson and encoding.TopologyData, and the topology of the geometries
+    geoms = np.asarray(geoms, dtype=object)
+    lat = np.mean(shapely.bounds(geoms)[:,[1,3]]) if len(geoms)>0 else 0
+    tolerance = zoom_tolerance(zoom, lat)
+    features = {'type': 'FeatureCollection', 
+                'features': [{'type': 'Feature', 'id': k, 'properties': {}, 'geometry': None} for k in ids]}
+    return json.dumps(features), to_topology(simplify(geoms, tolerance), tolerance/4)